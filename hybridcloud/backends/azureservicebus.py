@@ -4,16 +4,32 @@ import hashlib
 import hmac
 import urllib
 import string
-import time
-from azure.core.exceptions import ResourceNotFoundError
-from azure.mgmt.servicebus.v2021_06_01_preview.models import CheckNameAvailability, SBNamespace, SBSku, SBTopic, SBAuthorizationRule, RegenerateAccessKeyParameters, SBSubscription, AccessRights, SBQueue
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.mgmt.resource.resources.models import Deployment, DeploymentMode, DeploymentProperties
+from azure.mgmt.servicebus.v2021_06_01_preview.models import CheckNameAvailability, SBNamespace, SBSku, SBTopic, SBAuthorizationRule, RegenerateAccessKeyParameters, SBSubscription, AccessRights, SBQueue, Rule, SqlFilter, CorrelationFilter, FilterType
 from hybridcloud_core.configuration import get_one_of
 from hybridcloud_core.operator.reconcile_helpers import field_from_spec
-from ..util.azure import servicebus_client
+from ..util import k8s
+from ..util.azure import servicebus_client, resource_client
+from ..util.concurrency import run_parallel
+from ..util.instrumentation import instrumented
 
 
 ALLOWED_NAMESPACE_NAME_CHARACTERS = string.ascii_lowercase + string.digits + "-"
+ALLOWED_SKUS = ["Basic", "Standard", "Premium"]
 TAG_PREFIX = "hybridcloud-amqp-operator"
+SERVICEBUS_API_VERSION = "2021-06-01-preview"
+# Fields compared with the existing entities to decide if an update is needed
+BROKER_DIFF_FIELDS = ["sku.name", "sku.capacity"]
+TOPIC_DIFF_FIELDS = ["default_message_time_to_live", "max_size_in_megabytes", "support_ordering", "enable_partitioning", "enable_batched_operations", "max_message_size_in_kilobytes"]
+QUEUE_DIFF_FIELDS = ["default_message_time_to_live", "max_size_in_megabytes", "lock_duration", "dead_lettering_on_message_expiration", "max_delivery_count", "enable_partitioning", "enable_batched_operations", "max_message_size_in_kilobytes"]
+# Fields that can only be set when an entity is created
+IMMUTABLE_FIELDS = ["enable_partitioning"]
+SUBSCRIPTION_DIFF_FIELDS = ["default_message_time_to_live", "lock_duration", "dead_lettering_on_message_expiration", "max_delivery_count"]
+# Rule created by the operator for the filter of a subscription and the rule azure creates for every new subscription that accepts all messages
+FILTER_RULE_NAME = "filter"
+DEFAULT_RULE_NAME = "$Default"
+RULE_DIFF_FIELDS = ["filter_type", "sql_filter.sql_expression", "correlation_filter.correlation_id", "correlation_filter.label", "correlation_filter.properties"]
 
 
 def _backend_config(key, default=None, fail_if_missing=False):
@@ -40,6 +56,7 @@ def _calc_queue_consumer_name(namespace, name):
     return _backend_config("queue.name_pattern_consumer", default="{namespace}-{name}").format(namespace=namespace, name=name).lower()
 
 
+@instrumented("azureservicebus")
 class AzureServiceBusBackend:
     def __init__(self, logger):
         self._logger = logger
@@ -50,6 +67,11 @@ class AzureServiceBusBackend:
 
     def broker_spec_valid(self, namespace, name, spec):
         namespace_name = _calc_namespace_name(namespace, name)
+        parameters = self._broker_parameters(namespace, name, spec)
+        if parameters.sku.name not in ALLOWED_SKUS:
+            return (False, f"SKU '{parameters.sku.name}' is not supported. Allowed are: {', '.join(ALLOWED_SKUS)}")
+        if parameters.sku.capacity and parameters.sku.name != "Premium":
+            return (False, "capacity can only be set for the Premium SKU")
         if len(namespace_name) > 50:
             return (False, f"calculated broker name '{namespace_name}' is longer than 50 characters")
         for char in namespace_name:
@@ -68,19 +90,25 @@ class AzureServiceBusBackend:
         except ResourceNotFoundError:
             return False
 
-    def create_or_update_broker(self, namespace, name, spec, extra_tags=None):
-        namespace_name = _calc_namespace_name(namespace, name)
-        sku = _backend_config("sku", default="Basic")
-        capacity = _backend_config("capacity")
+    def _broker_parameters(self, namespace, name, spec, extra_tags=None):
+        sku = field_from_spec(spec or dict(), "sku", _backend_config("sku", default="Basic"))
+        capacity = field_from_spec(spec or dict(), "capacity", _backend_config("capacity"))
         if capacity:
             capacity = int(capacity)
-        parameters = SBNamespace(
+        return SBNamespace(
             location=self._location,
             tags=_tags(namespace, name, extra_tags),
             sku=SBSku(name=sku, tier=sku, capacity=capacity)
         )
+
+    def create_or_update_broker(self, namespace, name, spec, extra_tags=None):
+        namespace_name = _calc_namespace_name(namespace, name)
+        parameters = self._broker_parameters(namespace, name, spec, extra_tags)
         existing_namespace = self.broker_exists(namespace, name)
-        if not existing_namespace or existing_namespace.sku.name != parameters.sku.name or existing_namespace.sku.capacity != parameters.sku.capacity:
+        if existing_namespace and spec is None:
+            # Without a spec (e.g. when marking for deletion) keep the sku the namespace already has
+            parameters.sku = existing_namespace.sku
+        if not existing_namespace or extra_tags or _changed_fields(existing_namespace, parameters, BROKER_DIFF_FIELDS):
             namespace = self._servicebus_client.namespaces.begin_create_or_update(self._resource_group, namespace_name, parameters).result()
 
         return namespace_name
@@ -93,10 +121,211 @@ class AzureServiceBusBackend:
         else:
             self._servicebus_client.namespaces.begin_delete(self._resource_group, namespace_name).result()
 
+    def subtree_deployment_enabled(self):
+        return _backend_config("provisioning_mode", default="per_entity") == "arm_deployment"
+
+    def deploy_broker_subtree(self, namespace, name, spec, children):
+        """Provisions the namespace and all given child objects with one incremental ARM template deployment.
+           Returns the namespace name and a dict mapping (kind, namespace, name) of each child object to (success, message, entity name)"""
+        namespace_name = _calc_namespace_name(namespace, name)
+        template, resource_owners, entities = self._render_subtree_template(namespace, name, spec, namespace_name, children)
+        deployment_name = f"{TAG_PREFIX}-{namespace_name}"[:64]
+        client = resource_client()
+        parameters = Deployment(properties=DeploymentProperties(mode=DeploymentMode.INCREMENTAL, template=template))
+        deployment_error = None
+        try:
+            client.deployments.begin_create_or_update(self._resource_group, deployment_name, parameters).result()
+        except HttpResponseError as e:
+            self._logger.warn(f"ARM deployment {deployment_name} failed: {e.message}")
+            deployment_error = e
+
+        results = {owner: (True, "", entities.get(owner)) for owners in resource_owners.values() for owner in owners}
+        namespace_failed = False
+        try:
+            operations = list(client.deployment_operations.list(self._resource_group, deployment_name))
+        except ResourceNotFoundError:
+            # A deployment rejected in validation has no operations
+            operations = []
+        for operation in operations:
+            target = operation.properties.target_resource
+            if not target or operation.properties.provisioning_state != "Failed":
+                continue
+            message = str(operation.properties.status_message)
+            if target.resource_name == namespace_name:
+                namespace_failed = message
+            elif target.resource_name in resource_owners:
+                for owner in resource_owners[target.resource_name]:
+                    results[owner] = (False, message, entities.get(owner))
+        if namespace_failed:
+            raise Exception(f"Failed to deploy servicebus namespace {namespace_name}: {namespace_failed}")
+        if deployment_error and all(success for success, _, _ in results.values()):
+            # The failure could not be attributed to any child (e.g. a template or preflight error), so the namespace may not exist
+            raise deployment_error
+        return namespace_name, results
+
+    def _render_subtree_template(self, namespace, name, spec, namespace_name, children):
+        resources = []
+        resource_owners = dict()
+        # Name of the topic, subscription or queue created for each child object
+        entities = dict()
+        namespace_id = f"[resourceId('Microsoft.ServiceBus/namespaces', '{namespace_name}')]"
+
+        def _add(owner, resource_type, resource_name, parameters, depends_on):
+            # Shared authorization rules of the pooled credentials strategy are only rendered once but belong to all their users
+            if resource_name in resource_owners:
+                resource_owners[resource_name].append(owner)
+                return
+            resource = {
+                "type": resource_type,
+                "apiVersion": SERVICEBUS_API_VERSION,
+                "name": resource_name,
+                "dependsOn": depends_on,
+            }
+            resource.update(parameters.serialize())
+            resources.append(resource)
+            if owner:
+                resource_owners[resource_name] = [owner]
+
+        def _owner(kind, obj):
+            return (kind, obj["metadata"]["namespace"], obj["metadata"]["name"])
+
+        def _entity_name(calc_func, ref_obj, ref_field):
+            ref = ref_obj["spec"][ref_field]
+            return calc_func(ref.get("namespace", ref_obj["metadata"]["namespace"]), ref["name"])
+
+        _add(None, "Microsoft.ServiceBus/namespaces", namespace_name, self._broker_parameters(namespace, name, spec), [])
+        for obj in children.get("topics", []):
+            topic_name = _calc_topic_name(obj["metadata"]["namespace"], obj["metadata"]["name"])
+            topic_id = f"[resourceId('Microsoft.ServiceBus/namespaces/topics', '{namespace_name}', '{topic_name}')]"
+            entities[_owner("AMQPTopic", obj)] = topic_name
+            _add(_owner("AMQPTopic", obj), "Microsoft.ServiceBus/namespaces/topics", f"{namespace_name}/{topic_name}", _topic_parameters(obj["spec"]), [namespace_id])
+            _add(_owner("AMQPTopic", obj), "Microsoft.ServiceBus/namespaces/topics/authorizationRules", f"{namespace_name}/{topic_name}/{topic_name}-owner",
+                SBAuthorizationRule(rights=[AccessRights.MANAGE, AccessRights.LISTEN, AccessRights.SEND]), [topic_id])
+        for obj in children.get("subscriptions", []):
+            topic_name = _entity_name(_calc_topic_name, obj, "topicRef")
+            topic_id = f"[resourceId('Microsoft.ServiceBus/namespaces/topics', '{namespace_name}', '{topic_name}')]"
+            subscription_name = _calc_subscription_name(obj["metadata"]["namespace"], obj["metadata"]["name"])
+            if not _filter_rule(obj["spec"]):
+                # Filter rules are not part of the template, subscriptions with a filter are still updated by their handler
+                entities[_owner("AMQPTopicSubscription", obj)] = subscription_name
+            _add(_owner("AMQPTopicSubscription", obj), "Microsoft.ServiceBus/namespaces/topics/subscriptions", f"{namespace_name}/{topic_name}/{subscription_name}", _subscription_parameters(obj["spec"]), [topic_id])
+            rule_name = self._issued_topic_subscription_rule(obj.get("status"), subscription_name, topic_name) or subscription_name
+            _add(_owner("AMQPTopicSubscription", obj), "Microsoft.ServiceBus/namespaces/topics/authorizationRules", f"{namespace_name}/{topic_name}/{rule_name}",
+                SBAuthorizationRule(rights=[AccessRights.LISTEN]), [topic_id])
+        for obj in children.get("queues", []):
+            queue_name = _calc_queue_name(obj["metadata"]["namespace"], obj["metadata"]["name"])
+            queue_id = f"[resourceId('Microsoft.ServiceBus/namespaces/queues', '{namespace_name}', '{queue_name}')]"
+            entities[_owner("AMQPQueue", obj)] = queue_name
+            _add(_owner("AMQPQueue", obj), "Microsoft.ServiceBus/namespaces/queues", f"{namespace_name}/{queue_name}", _queue_parameters(obj["spec"]), [namespace_id])
+            _add(_owner("AMQPQueue", obj), "Microsoft.ServiceBus/namespaces/queues/authorizationRules", f"{namespace_name}/{queue_name}/{queue_name}-owner",
+                SBAuthorizationRule(rights=[AccessRights.MANAGE, AccessRights.LISTEN, AccessRights.SEND]), [queue_id])
+        for obj in children.get("consumers", []):
+            queue_name = _entity_name(_calc_queue_name, obj, "queueRef")
+            queue_id = f"[resourceId('Microsoft.ServiceBus/namespaces/queues', '{namespace_name}', '{queue_name}')]"
+            rule_name = self._issued_queue_consumer_rule(obj.get("status"), obj["metadata"]["namespace"], obj["metadata"]["name"], queue_name) or _calc_queue_consumer_name(obj["metadata"]["namespace"], obj["metadata"]["name"])
+            _add(_owner("AMQPQueueConsumer", obj), "Microsoft.ServiceBus/namespaces/queues/authorizationRules", f"{namespace_name}/{queue_name}/{rule_name}",
+                SBAuthorizationRule(rights=[AccessRights.LISTEN]), [queue_id])
+
+        template = {
+            "$schema": "https://schema.management.azure.com/schemas/2019-04-01/deploymentTemplate.json#",
+            "contentVersion": "1.0.0.0",
+            "resources": resources,
+        }
+        return template, resource_owners, entities
+
+    def plan(self, entries):
+        """Computes the actions the handlers would take for the given objects using bulk list calls instead of single lookups"""
+        namespaces = {ns.name: ns for ns in self._servicebus_client.namespaces.list_by_resource_group(self._resource_group)}
+        inventory = dict()
+
+        def _list(kind, namespace_name, *args):
+            if namespace_name not in namespaces:
+                return dict()
+            key = (kind, namespace_name) + args
+            if key not in inventory:
+                operations = {"topics": self._servicebus_client.topics.list_by_namespace, "queues": self._servicebus_client.queues.list_by_namespace,
+                    "subscriptions": self._servicebus_client.subscriptions.list_by_topic, "queue_rules": self._servicebus_client.queues.list_authorization_rules}
+                try:
+                    inventory[key] = {item.name: item for item in operations[kind](self._resource_group, namespace_name, *args)}
+                except ResourceNotFoundError:
+                    inventory[key] = dict()
+            return inventory[key]
+
+        def _action(existing, parameters, fields):
+            if not existing:
+                return "create", []
+            changes = _changed_fields(existing, parameters, fields)
+            return ("update" if changes else "noop"), changes
+
+        results = []
+        for entry in entries:
+            kind, namespace, name, spec = entry["kind"], entry["namespace"], entry["name"], entry["spec"]
+            namespace_name = _calc_namespace_name(*entry["broker"])
+            if kind == "AMQPBroker":
+                entity = namespace_name
+                action, changes = _action(namespaces.get(namespace_name), self._broker_parameters(namespace, name, spec), BROKER_DIFF_FIELDS)
+            elif kind == "AMQPTopic":
+                entity = f"{namespace_name}/{_calc_topic_name(namespace, name)}"
+                action, changes = _action(_list("topics", namespace_name).get(_calc_topic_name(namespace, name)), _topic_parameters(spec), TOPIC_DIFF_FIELDS)
+            elif kind == "AMQPQueue":
+                entity = f"{namespace_name}/{_calc_queue_name(namespace, name)}"
+                action, changes = _action(_list("queues", namespace_name).get(_calc_queue_name(namespace, name)), _queue_parameters(spec), QUEUE_DIFF_FIELDS)
+            elif kind == "AMQPTopicSubscription":
+                topic_name = _calc_topic_name(*entry["parent"])
+                subscription_name = _calc_subscription_name(namespace, name)
+                entity = f"{namespace_name}/{topic_name}/{subscription_name}"
+                action, changes = _action(_list("subscriptions", namespace_name, topic_name).get(subscription_name), _subscription_parameters(spec), SUBSCRIPTION_DIFF_FIELDS)
+                if action == "noop":
+                    # The subscription is always written by the handler
+                    action = "update"
+            elif kind == "AMQPQueueConsumer":
+                queue_name = _calc_queue_name(*entry["parent"])
+                rule_name = self._issued_queue_consumer_rule(entry["status"], namespace, name, queue_name) or _calc_queue_consumer_name(namespace, name)
+                entity = f"{namespace_name}/{queue_name}/{rule_name}"
+                action, changes = ("noop" if rule_name in _list("queue_rules", namespace_name, queue_name) else "create"), []
+            else:
+                continue
+            results.append({"kind": kind, "namespace": namespace, "name": name, "entity": entity, "action": action, "changes": changes})
+        return results
+
+    def message_counts(self, namespace_name, queue_names, subscriptions):
+        """Returns the active and dead-lettered message counts of the given queues (by name) and subscriptions (by (topic, subscription)).
+           Uses one list call for all queues and one per topic instead of a call per entity"""
+        def _queue_counts():
+            if not queue_names:
+                return dict()
+            return {queue.name: _message_counts(queue.count_details) for queue in self._servicebus_client.queues.list_by_namespace(self._resource_group, namespace_name) if queue.name in queue_names}
+
+        def _subscription_counts(topic_name):
+            def _list():
+                try:
+                    return {(topic_name, subscription.name): _message_counts(subscription.count_details) for subscription in self._servicebus_client.subscriptions.list_by_topic(self._resource_group, namespace_name, topic_name)}
+                except ResourceNotFoundError:
+                    return dict()
+            return _list
+
+        counts = dict()
+        for result in run_parallel(_queue_counts, *[_subscription_counts(topic_name) for topic_name in set(topic_name for topic_name, _ in subscriptions)]):
+            counts.update(result)
+        return counts
+
+    def broker_ready(self, namespace, name):
+        # create_or_update_broker waits for the provisioning of the namespace to finish
+        return True
+
+    def broker_delete_cascades(self):
+        # Deleting the servicebus namespace also deletes all topics, queues, subscriptions and authorization rules in it
+        return not _backend_config("fake_delete", default=False)
+
     def topic_spec_valid(self, namespace, name, spec, broker_name):
-        if not self.topic_exists(namespace, name, broker_name):
-            if self.queue_exists(namespace, name, broker_name):
-                return (False, "There is already a queue with the same name")
+        existing_topic, existing_queue = run_parallel(
+            lambda: self.topic_exists(namespace, name, broker_name),
+            lambda: self.queue_exists(namespace, name, broker_name),
+        )
+        if not existing_topic and existing_queue:
+            return (False, "There is already a queue with the same name")
+        if existing_topic and _changed_fields(existing_topic, _topic_parameters(spec), IMMUTABLE_FIELDS):
+            return (False, "Partitioning cannot be changed for an existing topic")
         topic_name = _calc_topic_name(namespace, name)
         if len(topic_name) > 260:
             return (False, f"calculated topic name '{topic_name}' is longer than 260 characters")
@@ -114,24 +343,9 @@ class AzureServiceBusBackend:
 
     def create_or_update_topic(self, namespace, name, spec, namespace_name):
         topic_name = _calc_topic_name(namespace, name)
-        default_message_ttl = field_from_spec(spec, "topic.defaultTTLSeconds", _backend_config("topic.parameters.default_ttl_seconds", default=60*60*24*30))
-        if default_message_ttl:
-            default_message_ttl = timedelta(seconds=int(default_message_ttl))
-        parameters = SBTopic(
-            default_message_time_to_live=default_message_ttl,
-            max_size_in_megabytes=_backend_config("topic.parameters.max_size_in_megabytes", default=None),
-            support_ordering=_backend_config("topic.parameters.support_ordering", default=False)
-        )
+        parameters = _topic_parameters(spec)
         existing_topic = self.topic_exists(namespace, name, namespace_name)
-        def diff():
-            if existing_topic.default_message_time_to_live != parameters.default_message_time_to_live:
-                return True
-            if existing_topic.max_size_in_megabytes != parameters.max_size_in_megabytes:
-                return True
-            if existing_topic.support_ordering != parameters.support_ordering:
-                return True
-            return False
-        if not existing_topic or diff():
+        if not existing_topic or _changed_fields(existing_topic, parameters, TOPIC_DIFF_FIELDS):
             self._servicebus_client.topics.create_or_update(self._resource_group, namespace_name, topic_name, parameters)
         return topic_name
 
@@ -159,36 +373,63 @@ class AzureServiceBusBackend:
 
     def create_or_update_topic_subscription(self, namespace, name, spec, topic_name, namespace_name):
         subscription_name = _calc_subscription_name(namespace, name)
-        default_message_ttl = field_from_spec(spec, "subscription.defaultTTLSeconds", _backend_config("subscription.parameters.default_ttl_seconds", default=60*60*24*30))
-        if default_message_ttl:
-            default_message_ttl = timedelta(seconds=int(default_message_ttl))
-        lock_duration = field_from_spec(spec, "subscription.lockDurationSeconds", _backend_config("subscription.parameters.lock_duration_seconds", default=60))
-        if lock_duration:
-            lock_duration = timedelta(seconds=int(lock_duration))
-        parameters = SBSubscription(
-            default_message_time_to_live=default_message_ttl,
-            lock_duration=lock_duration,
-            dead_lettering_on_message_expiration=field_from_spec(spec, "subscription.enableDeadLettering", _backend_config("subscription.parameters.dead_lettering_on_message_expiration", default=False)),
-            max_delivery_count=int(field_from_spec(spec, "subscription.maxDeliveryCount", _backend_config("subscription.parameters.max_delivery_count", default=10))),
-        )
+        parameters = _subscription_parameters(spec)
         self._servicebus_client.subscriptions.create_or_update(self._resource_group, namespace_name, topic_name, subscription_name, parameters)
+        self._update_subscription_rules(namespace_name, topic_name, subscription_name, _filter_rule(spec))
         return subscription_name
 
+    def _update_subscription_rules(self, namespace_name, topic_name, subscription_name, filter_rule):
+        """Makes the filter rule the only rule of the subscription. Without a filter the default rule accepting all messages is restored,
+           rules of subscriptions that never had a filter are not touched"""
+        rules_client = self._servicebus_client.rules
+        existing_rules = {rule.name: rule for rule in rules_client.list_by_subscriptions(self._resource_group, namespace_name, topic_name, subscription_name)}
+        if filter_rule:
+            desired_name, desired_rule = FILTER_RULE_NAME, filter_rule
+        elif FILTER_RULE_NAME in existing_rules:
+            desired_name, desired_rule = DEFAULT_RULE_NAME, Rule(filter_type=FilterType.SQL_FILTER, sql_filter=SqlFilter(sql_expression="1=1"))
+        else:
+            return
+        existing_rule = existing_rules.get(desired_name)
+        if not existing_rule or _changed_fields(existing_rule, desired_rule, RULE_DIFF_FIELDS):
+            rules_client.create_or_update(self._resource_group, namespace_name, topic_name, subscription_name, desired_name, desired_rule)
+        # Messages are delivered if any rule matches so all other rules have to go
+        for rule_name in existing_rules.keys():
+            if rule_name != desired_name:
+                rules_client.delete(self._resource_group, namespace_name, topic_name, subscription_name, rule_name)
+
     def delete_topic_subscription(self, namespace, name, topic_name, namespace_name):
         subscription_name = _calc_subscription_name(namespace, name)
         self._servicebus_client.subscriptions.delete(self._resource_group, namespace_name, topic_name, subscription_name)
 
-    def create_or_update_topic_subscription_credentials(self, subscription_name, topic_name, namespace_name, reset_credentials=False):
-        return self._create_or_update_topic_credentials(subscription_name, topic_name, namespace_name, [AccessRights.LISTEN], f"{topic_name}/Subscriptions/{subscription_name}", reset_credentials)
-
-    def delete_topic_subscription_credentials(self, subscription_name, topic_name, namespace_name):
+    def topic_subscription_credentials_rule(self, subscription_name, topic_name):
+        """Returns the name of the shared authorization rule new credentials of the subscription are derived from, None if it gets its own rule"""
+        if not _pooled_credentials():
+            return None
+        return _pooled_rule_name(topic_name, subscription_name)
+
+    def _issued_topic_subscription_rule(self, status, subscription_name, topic_name):
+        # Existing credentials stay on the rule they were issued from until they are issued again
+        if k8s.credentials_issued(status):
+            return status.get("credentials_rule")
+        return self.topic_subscription_credentials_rule(subscription_name, topic_name)
+
+    def create_or_update_topic_subscription_credentials(self, subscription_name, topic_name, namespace_name, reset_credentials=False, credentials_rule=None):
+        rule_name = credentials_rule or subscription_name
+        # The token is always scoped to the subscription, so a shared rule on the topic does not give access to other subscriptions
+        return self._create_or_update_topic_credentials(rule_name, topic_name, namespace_name, [AccessRights.LISTEN], f"{topic_name}/Subscriptions/{subscription_name}", reset_credentials)
+
+    def delete_topic_subscription_credentials(self, subscription_name, topic_name, namespace_name, credentials_rule=None):
+        rule_name = credentials_rule or subscription_name
         try:
-            self._servicebus_client.topics.delete_authorization_rule(self._resource_group, namespace_name, topic_name, subscription_name)
+            self._servicebus_client.topics.delete_authorization_rule(self._resource_group, namespace_name, topic_name, rule_name)
         except ResourceNotFoundError:
             pass
 
-    def topic_subscription_spec_valid(self, namespace, name, spec):
+    def topic_subscription_spec_valid(self, namespace, name, spec, topic_name=None, namespace_name=None):
         subscription_name = _calc_subscription_name(namespace, name)
+        subscription_filter = field_from_spec(spec, "subscription.filter", None) or dict()
+        if subscription_filter.get("sql") and subscription_filter.get("correlation"):
+            return (False, "Only one of filter.sql and filter.correlation can be set")
         if len(subscription_name) > 50:
             return (False, f"calculated subscription name '{subscription_name}' is longer than 50 characters")
         for char in subscription_name:
@@ -225,9 +466,14 @@ class AzureServiceBusBackend:
         }
 
     def queue_spec_valid(self, namespace, name, spec, namespace_name):
-        if not self.queue_exists(namespace, name, namespace_name):
-            if self.topic_exists(namespace, name, namespace_name):
-                return (False, "There is already a topic with the same name")
+        existing_queue, existing_topic = run_parallel(
+            lambda: self.queue_exists(namespace, name, namespace_name),
+            lambda: self.topic_exists(namespace, name, namespace_name),
+        )
+        if not existing_queue and existing_topic:
+            return (False, "There is already a topic with the same name")
+        if existing_queue and _changed_fields(existing_queue, _queue_parameters(spec), IMMUTABLE_FIELDS):
+            return (False, "Partitioning cannot be changed for an existing queue")
         queue_name = _calc_queue_name(namespace, name)
         if len(queue_name) > 260:
             return (False, f"calculated queue name '{queue_name}' is longer than 260 characters")
@@ -245,33 +491,9 @@ class AzureServiceBusBackend:
 
     def create_or_update_queue(self, namespace, name, spec, namespace_name):
         queue_name = _calc_queue_name(namespace, name)
-        default_message_ttl = field_from_spec(spec, "queue.defaultTTLSeconds", _backend_config("queue.parameters.default_ttl_seconds", default=60*60*24*30))
-        if default_message_ttl:
-            default_message_ttl = timedelta(seconds=int(default_message_ttl))
-        lock_duration = field_from_spec(spec, "queue.lockDurationSeconds", _backend_config("queue.parameters.lock_duration_seconds", default=60))
-        if lock_duration:
-            lock_duration = timedelta(seconds=int(lock_duration))
-        parameters = SBQueue(
-            default_message_time_to_live=default_message_ttl,
-            max_size_in_megabytes=_backend_config("queue.parameters.max_size_in_megabytes", default=None),
-            lock_duration=lock_duration,
-            dead_lettering_on_message_expiration=field_from_spec(spec, "queue.enableDeadLettering", _backend_config("queue.parameters.dead_lettering_on_message_expiration", default=False)),
-            max_delivery_count=int(field_from_spec(spec, "queue.maxDeliveryCount", _backend_config("queue.parameters.max_delivery_count", default=10))),
-        )
+        parameters = _queue_parameters(spec)
         existing_queue = self.queue_exists(namespace, name, namespace_name)
-        def diff():
-            if existing_queue.default_message_time_to_live != parameters.default_message_time_to_live:
-                return True
-            if existing_queue.max_size_in_megabytes != parameters.max_size_in_megabytes:
-                return True
-            if existing_queue.lock_duration != parameters.lock_duration:
-                return True
-            if existing_queue.dead_lettering_on_message_expiration != parameters.dead_lettering_on_message_expiration:
-                return True
-            if existing_queue.max_delivery_count != parameters.max_delivery_count:
-                return True
-            return False
-        if not existing_queue or diff():
+        if not existing_queue or _changed_fields(existing_queue, parameters, QUEUE_DIFF_FIELDS):
             self._servicebus_client.queues.create_or_update(self._resource_group, namespace_name, queue_name, parameters)
         return queue_name
 
@@ -299,18 +521,33 @@ class AzureServiceBusBackend:
                 return (False, f"Character '{char}' is not allowed in name. Allowed are: letters, digits and hyphens")
         return (True, "")
 
-    def create_or_update_queue_consumer_credentials(self, namespace, name, queue_name, namespace_name, reset_credentials=False):
+    def queue_consumer_credentials_rule(self, namespace, name, queue_name):
+        """Returns the name of the shared authorization rule new credentials of the consumer are derived from, None if it gets its own rule"""
+        if not _pooled_credentials():
+            return None
+        return _pooled_rule_name(queue_name, _calc_queue_consumer_name(namespace, name))
+
+    def _issued_queue_consumer_rule(self, status, namespace, name, queue_name):
+        # Existing credentials stay on the rule they were issued from until they are issued again
+        if k8s.credentials_issued(status):
+            return status.get("credentials_rule")
+        return self.queue_consumer_credentials_rule(namespace, name, queue_name)
+
+    def create_or_update_queue_consumer_credentials(self, namespace, name, queue_name, namespace_name, reset_credentials=False, credentials_rule=None):
+        if credentials_rule:
+            # The key of a shared rule must not be handed out, consumers get a token derived from it instead
+            return self._create_or_update_queue_credentials(credentials_rule, queue_name, namespace_name, [AccessRights.LISTEN], reset_credentials, scoped_token=True)
         consumer_name = _calc_queue_consumer_name(namespace, name)
         return self._create_or_update_queue_credentials(consumer_name, queue_name, namespace_name, [AccessRights.LISTEN], reset_credentials)
 
-    def delete_queue_consumer_credentials(self, namespace, name, queue_name, namespace_name):
-        consumer_name = _calc_queue_consumer_name(namespace, name)
+    def delete_queue_consumer_credentials(self, namespace, name, queue_name, namespace_name, credentials_rule=None):
+        rule_name = credentials_rule or _calc_queue_consumer_name(namespace, name)
         try:
-            self._servicebus_client.queues.delete_authorization_rule(self._resource_group, namespace_name, queue_name, consumer_name)
+            self._servicebus_client.queues.delete_authorization_rule(self._resource_group, namespace_name, queue_name, rule_name)
         except ResourceNotFoundError:
             pass
 
-    def _create_or_update_queue_credentials(self, token_name, queue_name, namespace_name, permissions, reset_credentials=False):
+    def _create_or_update_queue_credentials(self, token_name, queue_name, namespace_name, permissions, reset_credentials=False, scoped_token=False):
         # Create or update authorization rule
         parameters = SBAuthorizationRule(
             rights=permissions
@@ -324,6 +561,17 @@ class AzureServiceBusBackend:
         
         # Generate SAS token        
         keys = self._servicebus_client.queues.list_keys(self._resource_group, namespace_name, queue_name, token_name)
+        if scoped_token:
+            return {
+                "auth_method": "cbs",
+                "hostname": f"{namespace_name}.servicebus.windows.net",
+                "port": "5671",
+                "protocol": "amqps",
+                "user": "",
+                "password": "",
+                "token": _generate_sas_token(namespace_name, queue_name, token_name, keys.primary_key),
+                "entity": queue_name
+            }
         
         # Return token + needed info
         return {
@@ -338,6 +586,90 @@ class AzureServiceBusBackend:
         }
 
 
+def _field(obj, path):
+    for key in path.split("."):
+        obj = getattr(obj, key, None)
+    return obj
+
+
+def _changed_fields(existing, parameters, fields):
+    # Fields without a desired value are left to the defaults of azure and not compared
+    return [field for field in fields if _field(parameters, field) is not None and _field(existing, field) != _field(parameters, field)]
+
+
+def _message_counts(count_details):
+    if not count_details:
+        return {"active": 0, "deadLetter": 0}
+    return {"active": count_details.active_message_count or 0, "deadLetter": count_details.dead_letter_message_count or 0}
+
+
+def _throughput_parameters(spec, kind):
+    max_message_size = field_from_spec(spec, f"{kind}.maxMessageSizeInKilobytes", _backend_config(f"{kind}.parameters.max_message_size_in_kilobytes", default=None))
+    return dict(
+        enable_partitioning=field_from_spec(spec, f"{kind}.enablePartitioning", _backend_config(f"{kind}.parameters.enable_partitioning", default=False)),
+        enable_batched_operations=field_from_spec(spec, f"{kind}.enableBatchedOperations", _backend_config(f"{kind}.parameters.enable_batched_operations", default=True)),
+        max_message_size_in_kilobytes=int(max_message_size) if max_message_size else None,
+    )
+
+
+def _topic_parameters(spec):
+    default_message_ttl = field_from_spec(spec, "topic.defaultTTLSeconds", _backend_config("topic.parameters.default_ttl_seconds", default=60*60*24*30))
+    if default_message_ttl:
+        default_message_ttl = timedelta(seconds=int(default_message_ttl))
+    return SBTopic(
+        default_message_time_to_live=default_message_ttl,
+        max_size_in_megabytes=_backend_config("topic.parameters.max_size_in_megabytes", default=None),
+        support_ordering=_backend_config("topic.parameters.support_ordering", default=False),
+        **_throughput_parameters(spec, "topic")
+    )
+
+
+def _subscription_parameters(spec):
+    default_message_ttl = field_from_spec(spec, "subscription.defaultTTLSeconds", _backend_config("subscription.parameters.default_ttl_seconds", default=60*60*24*30))
+    if default_message_ttl:
+        default_message_ttl = timedelta(seconds=int(default_message_ttl))
+    lock_duration = field_from_spec(spec, "subscription.lockDurationSeconds", _backend_config("subscription.parameters.lock_duration_seconds", default=60))
+    if lock_duration:
+        lock_duration = timedelta(seconds=int(lock_duration))
+    return SBSubscription(
+        default_message_time_to_live=default_message_ttl,
+        lock_duration=lock_duration,
+        dead_lettering_on_message_expiration=field_from_spec(spec, "subscription.enableDeadLettering", _backend_config("subscription.parameters.dead_lettering_on_message_expiration", default=False)),
+        max_delivery_count=int(field_from_spec(spec, "subscription.maxDeliveryCount", _backend_config("subscription.parameters.max_delivery_count", default=10))),
+    )
+
+
+def _filter_rule(spec):
+    subscription_filter = field_from_spec(spec, "subscription.filter", None) or dict()
+    if subscription_filter.get("sql"):
+        return Rule(filter_type=FilterType.SQL_FILTER, sql_filter=SqlFilter(sql_expression=subscription_filter["sql"]))
+    correlation = subscription_filter.get("correlation")
+    if correlation:
+        return Rule(filter_type=FilterType.CORRELATION_FILTER, correlation_filter=CorrelationFilter(
+            correlation_id=correlation.get("correlationId"),
+            label=correlation.get("subject"),
+            properties=correlation.get("properties") or None,
+        ))
+    return None
+
+
+def _queue_parameters(spec):
+    default_message_ttl = field_from_spec(spec, "queue.defaultTTLSeconds", _backend_config("queue.parameters.default_ttl_seconds", default=60*60*24*30))
+    if default_message_ttl:
+        default_message_ttl = timedelta(seconds=int(default_message_ttl))
+    lock_duration = field_from_spec(spec, "queue.lockDurationSeconds", _backend_config("queue.parameters.lock_duration_seconds", default=60))
+    if lock_duration:
+        lock_duration = timedelta(seconds=int(lock_duration))
+    return SBQueue(
+        default_message_time_to_live=default_message_ttl,
+        max_size_in_megabytes=_backend_config("queue.parameters.max_size_in_megabytes", default=None),
+        lock_duration=lock_duration,
+        dead_lettering_on_message_expiration=field_from_spec(spec, "queue.enableDeadLettering", _backend_config("queue.parameters.dead_lettering_on_message_expiration", default=False)),
+        max_delivery_count=int(field_from_spec(spec, "queue.maxDeliveryCount", _backend_config("queue.parameters.max_delivery_count", default=10))),
+        **_throughput_parameters(spec, "queue")
+    )
+
+
 def _tags(namespace, name, extra_tags=None):
     tags = {f"{TAG_PREFIX}:namespace": namespace, f"{TAG_PREFIX}:name": name}
     for k, v in _backend_config("tags", default={}).items():
@@ -348,10 +680,26 @@ def _tags(namespace, name, extra_tags=None):
     return tags
 
 
+def _pooled_credentials():
+    return _backend_config("credentials.strategy", default="per_object") == "pooled"
+
+
+def _pooled_rule_name(entity_name, member_name):
+    # Members are spread over the pool by a stable hash so each object always maps to the same rule
+    index = int(hashlib.sha256(member_name.encode("utf-8")).hexdigest(), 16) % int(_backend_config("credentials.pool_size", default=4))
+    return f"{entity_name}-listen-{index}"
+
+
+# 2100-01-01T00:00:00Z
+SAS_TOKEN_EXPIRY = 4102444800
+
+
 def _generate_sas_token(servicebus_name, entity_path, authorization_rule_name, key):
     uri = urllib.parse.quote_plus(f"https://{servicebus_name}.servicebus.windows.net/{entity_path}")
     sas = key.encode('utf-8')
-    expiry = str(int(time.time() + 60*60*24*365*10)) # 10 years, we handle expiry via the authorization rules
+    # A fixed expiry makes the token depend only on the key, so the content hash of the secret only changes when the key changes.
+    # We handle expiry via the authorization rules
+    expiry = str(SAS_TOKEN_EXPIRY)
     string_to_sign = (uri + '\n' + expiry).encode('utf-8')
     signed_hmac_sha256 = hmac.HMAC(sas, string_to_sign, hashlib.sha256)
     signature = urllib.parse.quote(base64.b64encode(signed_hmac_sha256.digest()))
@@ -1,7 +1,10 @@
+import json
 import os
+import urllib.parse
 from hybridcloud_core.configuration import config_get
-import requests
-from ..util import helm
+from hybridcloud_core.operator.reconcile_helpers import field_from_spec
+from ..util import helm, circuit_breaker, instrumentation, recording
+from ..util.concurrency import run_parallel
 from ..util.constants import HELM_BASE_PATH
 
 
@@ -25,33 +28,143 @@ def _calc_subscription_name(namespace, name):
     return f"{namespace}-{name}"
 
 
+QUEUE_TYPES = ["classic", "quorum", "stream"]
+
+
+OVERFLOW_MODES = ["drop-head", "reject-publish", "reject-publish-dlx"]
+
+
+def _calc_dead_letter_queue_name(queue_name):
+    return f"{queue_name}-deadletter"
+
+
+def _queue_field(spec, prefix, field, config_key, default=None):
+    return field_from_spec(spec, f"{prefix}.{field}", _backend_config(f"{prefix}.{config_key}", default=default))
+
+
+def _queue_definition(spec, prefix, queue_name):
+    """Builds the queue declaration for a queue or subscription. Quorum and stream queues are always durable,
+       classic queues keep the non-durable default so existing queues can still be declared"""
+    queue_type = _queue_field(spec, prefix, "type", "type", default="classic")
+    arguments = dict()
+    durable = True
+    if queue_type == "classic":
+        durable = _backend_config(f"{prefix}.durable", default=False)
+    else:
+        arguments["x-queue-type"] = queue_type
+    if queue_type == "quorum":
+        max_delivery_count = _queue_field(spec, prefix, "maxDeliveryCount", "max_delivery_count")
+        if max_delivery_count:
+            arguments["x-delivery-limit"] = int(max_delivery_count)
+    max_length_bytes = _queue_field(spec, prefix, "maxLengthBytes", "max_length_bytes")
+    if max_length_bytes:
+        arguments["x-max-length-bytes"] = int(max_length_bytes)
+    if queue_type == "stream":
+        # Streams do not support the other arguments
+        return {"auto_delete": False, "durable": durable, "arguments": arguments}
+    ttl = _queue_field(spec, prefix, "defaultTTLSeconds", "default_ttl_seconds")
+    if ttl:
+        arguments["x-message-ttl"] = int(ttl) * 1000
+    max_length = _queue_field(spec, prefix, "maxLength", "max_length")
+    if max_length:
+        arguments["x-max-length"] = int(max_length)
+    overflow = _queue_field(spec, prefix, "overflow", "overflow")
+    if overflow and (max_length or max_length_bytes):
+        arguments["x-overflow"] = overflow
+    if _queue_field(spec, prefix, "enableDeadLettering", "dead_lettering", default=False):
+        # Like the dead letter subqueue in azure, dead letters are routed via the default exchange to a queue next to the original one
+        arguments["x-dead-letter-exchange"] = ""
+        arguments["x-dead-letter-routing-key"] = _calc_dead_letter_queue_name(queue_name)
+    if queue_type == "classic" and _queue_field(spec, prefix, "lazy", "lazy", default=False):
+        arguments["x-queue-mode"] = "lazy"
+    return {"auto_delete": False, "durable": durable, "arguments": arguments}
+
+
+def _validate_queue_type(spec, prefix):
+    queue_type = field_from_spec(spec, f"{prefix}.type", _backend_config(f"{prefix}.type", default="classic"))
+    if queue_type not in QUEUE_TYPES:
+        return (False, f"Queue type '{queue_type}' is not supported. Allowed are: {', '.join(QUEUE_TYPES)}")
+    overflow = field_from_spec(spec, f"{prefix}.overflow", _backend_config(f"{prefix}.overflow", default=None))
+    if overflow and overflow not in OVERFLOW_MODES:
+        return (False, f"Overflow mode '{overflow}' is not supported. Allowed are: {', '.join(OVERFLOW_MODES)}")
+    return (True, "")
+
+
+EXCHANGE_TYPES = ["fanout", "topic", "headers"]
+
+
+def _subscription_filter(spec):
+    return field_from_spec(spec, "subscription.filter", None) or dict()
+
+
+def _validate_filter(exchange_type, spec):
+    subscription_filter = _subscription_filter(spec)
+    correlation = subscription_filter.get("correlation") or dict()
+    if subscription_filter.get("sql"):
+        return (False, "SQL filters are not supported by the rabbitmq backend")
+    if correlation.get("correlationId"):
+        return (False, "Filtering by correlationId is not supported by the rabbitmq backend")
+    if correlation.get("subject") and exchange_type != "topic":
+        return (False, f"Filtering by subject requires a topic with exchange type topic, the topic has type {exchange_type}")
+    if correlation.get("properties") and exchange_type != "headers":
+        return (False, f"Filtering by properties requires a topic with exchange type headers, the topic has type {exchange_type}")
+    return (True, "")
+
+
+def _binding(exchange_type, spec):
+    """Translates the filter of a subscription into the binding key and arguments for the type of the topic exchange"""
+    correlation = _subscription_filter(spec).get("correlation") or dict()
+    if exchange_type == "topic":
+        return {"routing_key": correlation.get("subject") or "#", "arguments": {}}
+    if exchange_type == "headers":
+        # A headers binding with only x-match and no further arguments matches all messages
+        arguments = {"x-match": "all"}
+        arguments.update(correlation.get("properties") or dict())
+        return {"routing_key": "", "arguments": arguments}
+    return {"routing_key": "", "arguments": {}}
+
+
 class RabbitMQException(Exception):
-    pass
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        # Keep the response so failures can be classified by status code and Retry-After
+        self.response = response
 
 
+@instrumentation.instrumented("rabbitmq")
 class RabbitMQBackend:
     def __init__(self, logger):
         self._logger = logger
         self._admin_auth = ("admin", "admin")
+        self._timeout = float(_backend_config("api_timeout_seconds", default=10))
+        self._session = recording.session("rabbitmq")
+
+    def _api_request(self, method, broker, url, json=None, fail=False):
+        def _request():
+            response = instrumentation.timed("http", "rabbitmq", method, lambda: self._session.request(method, f"http://{broker}.svc.cluster.local:15672/api/{url}", json=json, auth=self._admin_auth, timeout=self._timeout), broker=broker, url=url)
+            if response.status_code >= 500:
+                raise RabbitMQException(f"Failed to execute operation: {response.status_code}: {response.text}", response)
+            return response
+        if circuit_breaker.enabled():
+            response = circuit_breaker.circuit_breaker(f"rabbitmq:{broker}").call(_request)
+        else:
+            response = _request()
+        if fail and not response.ok:
+            raise RabbitMQException(f"Failed to execute operation: {response.status_code}: {response.text}", response)
+        return response
 
     def _api_get(self, broker, url, json=None):
-        return requests.get(f"http://{broker}.svc.cluster.local:15672/api/{url}", json=json, auth=self._admin_auth)
+        return self._api_request("GET", broker, url, json=json)
     
     def _api_post(self, broker, url, json=None):
-        response = requests.post(f"http://{broker}.svc.cluster.local:15672/api/{url}", json=json, auth=self._admin_auth)
-        if not response.ok:
-            raise RabbitMQException(f"Failed to execute operation: {response.status_code}: {response.text}")
-        return response
+        return self._api_request("POST", broker, url, json=json, fail=True)
 
     def _api_put(self, broker, url, json=None):
-        response = requests.put(f"http://{broker}.svc.cluster.local:15672/api/{url}", json=json, auth=self._admin_auth)
-        if not response.ok:
-            raise RabbitMQException(f"Failed to execute operation: {response.status_code}: {response.text}")
-        return response
+        return self._api_request("PUT", broker, url, json=json, fail=True)
 
     def _api_delete(self, broker, url):
-        return requests.delete(f"http://{broker}.svc.cluster.local:15672/api/{url}", auth=self._admin_auth)       
-        
+        return self._api_request("DELETE", broker, url)
+
     def broker_spec_valid(self, namespace, name, spec):
         broker_name = _calc_helm_release_name(namespace, name)
         if len(broker_name) > 63:
@@ -63,26 +176,112 @@ class RabbitMQBackend:
 
     def create_or_update_broker(self, namespace, name, spec, extra_tags=None):
         helm_release = _calc_helm_release_name(namespace, name)
-        values = f"""
-fullnameOverride: {helm_release}
-auth:
-  username: admin
-  password: admin
-extraPlugins: "rabbitmq_amqp1_0"
-clustering:
-  enabled: false
-        """
-        helm.install_upgrade(namespace, helm_release, os.path.join(HELM_BASE_PATH, "rabbitmq"), "--wait", values=values)
+        spec = spec or dict()
+        replicas = int(field_from_spec(spec, "replicas", _backend_config("broker.replicas", default=1)))
+        values = {
+            "fullnameOverride": helm_release,
+            "auth": {
+                "username": "admin",
+                "password": "admin",
+            },
+            "extraPlugins": "rabbitmq_amqp1_0",
+            "replicaCount": replicas,
+            # A broker with several replicas only works as a cluster
+            "clustering": {
+                "enabled": replicas > 1 or field_from_spec(spec, "clustering", _backend_config("broker.clustering", default=False)),
+            },
+        }
+        resources = field_from_spec(spec, "resources", _backend_config("broker.resources", default=None))
+        if resources:
+            values["resources"] = resources
+        # json is valid yaml
+        # No --wait so the install does not block until the pods are running, readiness is checked with broker_ready
+        helm.install_upgrade(namespace, helm_release, os.path.join(HELM_BASE_PATH, "rabbitmq"), "", values=json.dumps(values))
         return f"{helm_release}.{namespace}"
 
+    def broker_ready(self, namespace, name):
+        broker = f"{_calc_helm_release_name(namespace, name)}.{namespace}"
+        # Bypasses the circuit breaker as a broker that is still starting is expected to refuse connections
+        try:
+            response = instrumentation.timed("http", "rabbitmq", "GET", lambda: self._session.request("GET", f"http://{broker}.svc.cluster.local:15672/api/overview", auth=self._admin_auth, timeout=self._timeout), broker=broker, url="overview")
+        except OSError:
+            return False
+        return response.ok
+
     def delete_broker(self, namespace, name):
         helm_release = _calc_helm_release_name(namespace, name)
         helm.uninstall(namespace, helm_release)
 
+    def subtree_deployment_enabled(self):
+        return False
+
+    def plan(self, entries):
+        """Computes the actions the handlers would take for the given objects using one list call per broker and entity type"""
+        releases = set((release["namespace"], release["name"]) for release in helm.list_all())
+        inventory = dict()
+
+        def _list(broker_name, kind):
+            key = (broker_name, kind)
+            if key not in inventory:
+                path = kind if kind == "users" else f"{kind}/%2F"
+                response = self._api_get(broker_name, f"{path}?columns=name")
+                inventory[key] = set(item["name"] for item in response.json()) if response.ok else set()
+            return inventory[key]
+
+        results = []
+        for entry in entries:
+            kind, namespace, name = entry["kind"], entry["namespace"], entry["name"]
+            broker_namespace, broker_k8s_name = entry["broker"]
+            helm_release = _calc_helm_release_name(broker_namespace, broker_k8s_name)
+            broker_name = f"{helm_release}.{broker_namespace}"
+            broker_installed = (broker_namespace, helm_release) in releases
+            if kind == "AMQPBroker":
+                # helm upgrade is always run by the handler
+                entity, action = helm_release, "update" if broker_installed else "create"
+            elif kind == "AMQPTopic":
+                entity = _calc_topic_name(namespace, name)
+                action = "noop" if broker_installed and entity in _list(broker_name, "exchanges") else "create"
+            elif kind == "AMQPQueue":
+                entity = _calc_queue_name(namespace, name)
+                action = "noop" if broker_installed and entity in _list(broker_name, "queues") else "create"
+            elif kind == "AMQPTopicSubscription":
+                entity = _calc_subscription_name(namespace, name)
+                action = "noop" if broker_installed and entity in _list(broker_name, "queues") else "create"
+            elif kind == "AMQPQueueConsumer":
+                entity = f"consumer-{namespace}-{name}"
+                action = "noop" if broker_installed and entity in _list(broker_name, "users") else "create"
+            else:
+                continue
+            results.append({"kind": kind, "namespace": namespace, "name": name, "entity": entity, "action": action, "changes": []})
+        return results
+
+    def message_counts(self, broker_name, queue_names, subscriptions):
+        """Returns the ready and dead-lettered message counts of the given queues (by name) and subscriptions (by (topic, subscription)) with one call"""
+        response = self._api_get(broker_name, "queues/%2F?columns=name,messages_ready")
+        if not response.ok:
+            raise RabbitMQException(f"Failed to list queues: {response.status_code}: {response.text}", response)
+        ready = {queue["name"]: queue.get("messages_ready") or 0 for queue in response.json()}
+
+        def _counts(queue_name):
+            return {"active": ready[queue_name], "deadLetter": ready.get(_calc_dead_letter_queue_name(queue_name), 0)}
+        counts = {queue_name: _counts(queue_name) for queue_name in queue_names if queue_name in ready}
+        counts.update({(topic_name, subscription_name): _counts(subscription_name) for topic_name, subscription_name in subscriptions if subscription_name in ready})
+        return counts
+
+    def broker_delete_cascades(self):
+        # Uninstalling the helm release removes the broker including all exchanges, queues and users
+        return True
+
     def topic_spec_valid(self, namespace, name, spec, broker_name):
-        if not self.topic_exists(namespace, name, broker_name):
-            if self.queue_exists(namespace, name, broker_name):
-                return (False, "There is already a queue with the same name")
+        exchange_type = _backend_config("topic.exchange_type", default="fanout")
+        if exchange_type not in EXCHANGE_TYPES:
+            return (False, f"Exchange type '{exchange_type}' is not supported. Allowed are: {', '.join(EXCHANGE_TYPES)}")
+        existing_topic, existing_queue = run_parallel(
+            lambda: self.topic_exists(namespace, name, broker_name),
+            lambda: self.queue_exists(namespace, name, broker_name),
+        )
+        if not existing_topic and existing_queue:
+            return (False, "There is already a queue with the same name")
         return True, ""
 
     def topic_exists(self, namespace, name, broker_name):
@@ -90,9 +289,17 @@ clustering:
         response = self._api_get(broker_name, f"exchanges/%2F/{topic_name}")
         return response.ok
 
+    def _exchange_type(self, broker_name, topic_name):
+        response = self._api_get(broker_name, f"exchanges/%2F/{topic_name}")
+        if response.ok:
+            return response.json().get("type")
+        return None
+
     def create_or_update_topic(self, namespace, name, spec, broker_name):
         topic_name = _calc_topic_name(namespace, name)
-        self._api_put(broker_name, f"exchanges/%2F/{topic_name}", json={"type":"fanout","auto_delete":False,"durable":True,"internal":False,"arguments":{}})
+        # The type of an existing exchange cannot be changed, so only new topics get the configured type
+        exchange_type = self._exchange_type(broker_name, topic_name) or _backend_config("topic.exchange_type", default="fanout")
+        self._api_put(broker_name, f"exchanges/%2F/{topic_name}", json={"type":exchange_type,"auto_delete":False,"durable":True,"internal":False,"arguments":{}})
         return topic_name
 
     def delete_topic(self, namespace, name, broker_name):
@@ -117,8 +324,11 @@ clustering:
         username = f"{topic_name}-owner"
         self._delete_user(username, broker_name)
 
-    def topic_subscription_spec_valid(self, namespace, name, spec):
-        return (True, "")
+    def topic_subscription_spec_valid(self, namespace, name, spec, topic_name=None, broker_name=None):
+        valid, reason = _validate_queue_type(spec, "subscription")
+        if not valid or not broker_name:
+            return (valid, reason)
+        return _validate_filter(self._exchange_type(broker_name, topic_name), spec)
 
     def topic_subscription_exists(self, namespace, name, topic_name, broker_name):
         subscription_name = _calc_subscription_name(namespace, name)
@@ -127,16 +337,35 @@ clustering:
 
     def create_or_update_topic_subscription(self, namespace, name, spec, topic_name, broker_name):
         subscription_name = _calc_subscription_name(namespace, name)
-        self._api_put(broker_name, f"queues/%2F/{subscription_name}", json={"auto_delete":False,"durable":False,"arguments":{}})
-        self._api_post(broker_name, f"bindings/%2F/e/{topic_name}/q/{subscription_name}", json={})
+        self._declare_queue(broker_name, subscription_name, _queue_definition(spec, "subscription", subscription_name))
+        self._update_binding(broker_name, topic_name, subscription_name, _binding(self._exchange_type(broker_name, topic_name), spec))
         return subscription_name
 
+    def _update_binding(self, broker_name, topic_name, subscription_name, binding):
+        """Makes the given binding the only binding between the topic exchange and the subscription queue"""
+        path = f"bindings/%2F/e/{topic_name}/q/{subscription_name}"
+        response = self._api_get(broker_name, path)
+        existing_bindings = response.json() if response.ok else []
+
+        def _matches(existing):
+            return existing.get("routing_key") == binding["routing_key"] and (existing.get("arguments") or dict()) == binding["arguments"]
+        if not any(_matches(existing) for existing in existing_bindings):
+            self._api_post(broker_name, path, json=binding)
+        for existing in existing_bindings:
+            if not _matches(existing):
+                self._api_delete(broker_name, f"{path}/{urllib.parse.quote(existing['properties_key'], safe='')}")
+
     def delete_topic_subscription(self, namespace, name, topic_name, broker_name):
         subscription_name = _calc_subscription_name(namespace, name)
         self._api_delete(broker_name, f"bindings/%2F/e/{topic_name}/q/{subscription_name}/~")
         self._api_delete(broker_name, f"queues/%2F/{subscription_name}")
+        self._api_delete(broker_name, f"queues/%2F/{_calc_dead_letter_queue_name(subscription_name)}")
+
+    def topic_subscription_credentials_rule(self, subscription_name, topic_name):
+        # Every subscription has its own user
+        return None
 
-    def create_or_update_topic_subscription_credentials(self, subscription_name, topic_name, broker_name, reset_credentials=False):
+    def create_or_update_topic_subscription_credentials(self, subscription_name, topic_name, broker_name, reset_credentials=False, credentials_rule=None):
         username = f"subscription-{subscription_name}"
         password = self._create_or_update_user(username, broker_name, reset_credentials)
         return {
@@ -150,14 +379,20 @@ clustering:
             "entity": f"/queue/{subscription_name}"
         }
 
-    def delete_topic_subscription_credentials(self, subscription_name, topic_name, broker_name):
+    def delete_topic_subscription_credentials(self, subscription_name, topic_name, broker_name, credentials_rule=None):
         username = f"subscription-{subscription_name}"
         self._delete_user(username, broker_name)
 
     def queue_spec_valid(self, namespace, name, spec, broker_name):
-        if not self.queue_exists(namespace, name, broker_name):
-            if self.topic_exists(namespace, name, broker_name):
-                return (False, "There is already a topic with the same name")
+        valid, reason = _validate_queue_type(spec, "queue")
+        if not valid:
+            return (valid, reason)
+        existing_queue, existing_topic = run_parallel(
+            lambda: self.queue_exists(namespace, name, broker_name),
+            lambda: self.topic_exists(namespace, name, broker_name),
+        )
+        if not existing_queue and existing_topic:
+            return (False, "There is already a topic with the same name")
         return True, ""
 
     def queue_exists(self, namespace, name, broker_name):
@@ -167,12 +402,13 @@ clustering:
 
     def create_or_update_queue(self, namespace, name, spec, broker_name):
         queue_name = _calc_queue_name(namespace, name)
-        self._api_put(broker_name, f"queues/%2F/{queue_name}", json={"auto_delete":False,"durable":False,"arguments":{}})
+        self._declare_queue(broker_name, queue_name, _queue_definition(spec, "queue", queue_name))
         return queue_name
 
     def delete_queue(self, namespace, name, broker_name):
         queue_name = _calc_queue_name(namespace, name)
         self._api_delete(broker_name, f"queues/%2F/{queue_name}")
+        self._api_delete(broker_name, f"queues/%2F/{_calc_dead_letter_queue_name(queue_name)}")
 
     def create_or_update_queue_credentials(self, queue_name, broker_name, reset_credentials=False):
         username = f"{queue_name}-owner"
@@ -195,7 +431,11 @@ clustering:
     def queue_consumer_spec_valid(self, namespace, name, spec):
         return (True, "")
 
-    def create_or_update_queue_consumer_credentials(self, namespace, name, queue_name, broker_name, reset_credentials=False):
+    def queue_consumer_credentials_rule(self, namespace, name, queue_name):
+        # Every consumer has its own user
+        return None
+
+    def create_or_update_queue_consumer_credentials(self, namespace, name, queue_name, broker_name, reset_credentials=False, credentials_rule=None):
         username = f"consumer-{namespace}-{name}"
         password = self._create_or_update_user(username, broker_name, reset_credentials)
         return {
@@ -209,10 +449,27 @@ clustering:
             "entity": f"/queue/{queue_name}"
         }
 
-    def delete_queue_consumer_credentials(self, namespace, name, queue_name, broker_name):
+    def delete_queue_consumer_credentials(self, namespace, name, queue_name, broker_name, credentials_rule=None):
         username = f"consumer-{namespace}-{name}"
         self._delete_user(username, broker_name)
 
+    def _get_queue(self, broker_name, queue_name):
+        response = self._api_get(broker_name, f"queues/%2F/{queue_name}")
+        return response.json() if response.ok else None
+
+    def _declare_queue(self, broker_name, queue_name, definition):
+        """Declares the queue if it does not exist yet. Rabbitmq rejects redeclaring a queue with different arguments,
+           so changed arguments of an existing queue are only reported and apply once the queue is recreated"""
+        existing_queue = self._get_queue(broker_name, queue_name)
+        if existing_queue is not None:
+            if existing_queue.get("durable") != definition["durable"] or (existing_queue.get("arguments") or dict()) != definition["arguments"]:
+                self._logger.warning(f"Queue {queue_name} exists with other arguments than configured, delete and recreate the object to apply them")
+            return
+        if "x-dead-letter-routing-key" in definition["arguments"]:
+            dead_letter_definition = {"auto_delete": False, "durable": definition["durable"], "arguments": dict()}
+            self._api_put(broker_name, f"queues/%2F/{definition['arguments']['x-dead-letter-routing-key']}", json=dead_letter_definition)
+        self._api_put(broker_name, f"queues/%2F/{queue_name}", json=definition)
+
     def _create_or_update_user(self, username, broker_name, reset_credentials=False):
         response = self._api_get(broker_name, f"users/{username}")
         password = username
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 import kopf
 from .routing import amqp_backend
@@ -6,51 +7,116 @@ from hybridcloud_core.operator.reconcile_helpers import ignore_control_label_cha
 from hybridcloud_core.k8s.api import patch_namespaced_custom_object_status
 from ..util import k8s
 from ..util.constants import BACKOFF
+from ..util.profiling import profiled
+from ..util.timings import PhaseTimings, VALIDATION, ENTITY
+from ..util.executors import dispatched, undispatched, PROVISIONING
+from ..util.retry import retry_policy, wait_for
+from .helpers import broker_children, deployable_broker_children
+from ..util.secrets import delete_credentials_secret
 
 
 if config_get("handler_on_resume", default=False):
-    @kopf.on.resume(*k8s.AMQPBroker.kopf_on(), backoff=BACKOFF)
+    @kopf.on.resume(*k8s.AMQPBroker.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+    @dispatched(PROVISIONING)
     def broker_resume(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs):
-        broker_manage(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs)
+        undispatched(broker_manage)(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs)
 
 
-@kopf.on.create(*k8s.AMQPBroker.kopf_on(), backoff=BACKOFF)
-@kopf.on.update(*k8s.AMQPBroker.kopf_on(), backoff=BACKOFF)
+@kopf.on.create(*k8s.AMQPBroker.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+@kopf.on.update(*k8s.AMQPBroker.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+@dispatched(PROVISIONING)
+@retry_policy
+@profiled
 def broker_manage(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs):
     if ignore_control_label_change(diff):
         logger.debug("Only control labels removed. Nothing to do.")
         return
 
+    timings = PhaseTimings(body["kind"], meta, kwargs.get("started"))
     if status and "backend" in status:
         backend_name = status["backend"]
     else:
         backend_name = spec.get("backend", config_get("backend", fail_if_missing=True))
     backend = amqp_backend(backend_name, logger)
 
-    valid, reason = backend.broker_spec_valid(namespace, name, spec)
+    with timings.phase(VALIDATION):
+        valid, reason = backend.broker_spec_valid(namespace, name, spec)
     if not valid:
-        _status(name, namespace, status, "failed", f"Validation failed: {reason}")
+        _status(name, namespace, status, "failed", f"Validation failed: {reason}", timings=timings)
         raise kopf.PermanentError("Spec is invalid, check status for details")
 
     # Create broker
-    broker_name = backend.create_or_update_broker(namespace, name, spec)
+    with timings.phase(ENTITY):
+        if backend.subtree_deployment_enabled():
+            children = deployable_broker_children(namespace, name)
+            broker_name, results = backend.deploy_broker_subtree(namespace, name, spec, children)
+            _report_subtree_results(broker_name, children, results, logger)
+        else:
+            broker_name = backend.create_or_update_broker(namespace, name, spec)
+
+    # Some backends return before the broker is running, children wait for it to become ready as well
+    if not backend.broker_ready(namespace, name):
+        _status(name, namespace, status, "working", "Waiting for broker to become ready", backend=backend_name, broker_name=broker_name)
+        wait_for("Waiting for broker to become ready.")
 
     # mark success
-    _status(name, namespace, status, "finished", "Broker created", backend=backend_name, broker_name=broker_name)
+    _status(name, namespace, status, "finished", "Broker created", backend=backend_name, broker_name=broker_name, timings=timings)
 
 
-@kopf.on.delete(*k8s.AMQPBroker.kopf_on(), backoff=BACKOFF)
+@kopf.on.delete(*k8s.AMQPBroker.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+@dispatched(PROVISIONING)
+@retry_policy
 def broker_delete(spec, status, name, namespace, logger, **kwargs):
     if status and "backend" in status:
         backend_name = status["backend"]
     else:
         backend_name = config_get("backend", fail_if_missing=True)
     backend = amqp_backend(backend_name, logger)
+    if backend.broker_delete_cascades():
+        _delete_child_secrets(namespace, name, logger)
     if backend.broker_exists(namespace, name):
         backend.delete_broker(namespace, name)
 
 
-def _status(name, namespace, status_obj, status, reason=None, backend=None, endpoint=None, broker_name=None):
+def _report_subtree_results(broker_name, children, results, logger):
+    """Marks child objects whose resources failed in the combined deployment as failed. Successful ones are finished by their own handlers,
+       which skip creating the entity as long as the spec is the one it was deployed for"""
+    specs = {(obj["metadata"]["namespace"], obj["metadata"]["name"], obj["kind"]): obj["spec"] for objects in children.values() for obj in objects}
+    failed = 0
+    for (kind, child_namespace, child_name), (success, message, entity) in results.items():
+        if success:
+            if entity:
+                patch_namespaced_custom_object_status(getattr(k8s, kind), child_namespace, child_name, {"provisioned": {
+                    "broker_name": broker_name,
+                    "entity": entity,
+                    "specHash": k8s.spec_hash(specs[(child_namespace, child_name, kind)]),
+                }})
+            continue
+        failed += 1
+        patch_namespaced_custom_object_status(getattr(k8s, kind), child_namespace, child_name, {"deployment": {
+            "status": "failed",
+            "reason": f"Deployment together with broker failed: {message}",
+            "latest-update": datetime.now(tz=timezone.utc).isoformat()
+        }})
+    logger.info(f"Deployed broker with {len(results)} child objects, {failed} failed")
+
+
+def _delete_child_secrets(namespace, name, logger):
+    """Deletes the credential secrets of all child objects that are being deleted together with the broker in parallel"""
+    secrets = []
+    for objects in broker_children(namespace, name).values():
+        for obj in objects:
+            if k8s.marked_for_deletion(obj):
+                secrets.append((obj["metadata"]["namespace"], obj["spec"]["credentialsSecret"]))
+    if not secrets:
+        return
+    logger.info(f"Deleting {len(secrets)} credential secrets of child objects")
+    with ThreadPoolExecutor(max_workers=int(config_get("teardown.max_parallel_deletes", default=10))) as executor:
+        for future in [executor.submit(delete_credentials_secret, secret_namespace, secret_name) for secret_namespace, secret_name in secrets]:
+            future.result()
+
+
+def _status(name, namespace, status_obj, status, reason=None, backend=None, endpoint=None, broker_name=None, timings=None):
     if status_obj:
         new_status = dict()
         for k, v in status_obj.items():
@@ -64,6 +130,8 @@ def _status(name, namespace, status_obj, status, reason=None, backend=None, endp
         status_obj["endpoint"] = endpoint
     if broker_name:
         status_obj["broker_name"] = broker_name
+    if timings and status == "finished":
+        status_obj["timings"] = timings.status(status_obj.get("timings"))
     status_obj["deployment"] = {
         "status": status,
         "reason": reason,
@@ -1,21 +1,190 @@
+import threading
 import kopf
 from hybridcloud_core.configuration import config_get
-from hybridcloud_core.k8s.api import get_namespaced_custom_object
+from hybridcloud_core.k8s.api import get_namespaced_custom_object, patch_namespaced_custom_object_status
 from ..util import k8s
+from ..util.retry import wait_for
 from .routing import amqp_backend
 
 
-def wait_for_amqp_broker(logger, broker_namespace, broker_name, retry):
+# Serializes pool placements so concurrent handlers see the placements of each other
+_placement_lock = threading.Lock()
+
+
+def wait_for_amqp_broker(logger, broker_namespace, broker_name):
     broker_object = get_namespaced_custom_object(k8s.AMQPBroker, broker_namespace, broker_name)
     if not broker_object:
-        raise kopf.TemporaryError("Waiting for broker object to be created.", delay=10 if retry < 5 else 20 if retry < 10 else 30)
+        wait_for("Waiting for broker object to be created.")
 
     status = broker_object.get("status")
     if not status or not "broker_name" in status:
-        raise kopf.TemporaryError("Waiting for broker to be created by backend.", delay=10 if retry < 5 else 20 if retry < 10 else 30)
+        wait_for("Waiting for broker to be created by backend.")
     backend_name = status.get("backend", broker_object.get("spec", dict()).get("backend", config_get("backend", fail_if_missing=True)))
     backend = amqp_backend(backend_name, logger)
 
     if not backend.broker_exists(broker_namespace, broker_name):
-        raise kopf.TemporaryError("Waiting for broker to be finished creating by backend.", delay=10 if retry < 5 else 20 if retry < 10 else 30)
+        wait_for("Waiting for broker to be finished creating by backend.")
+    # The broker handler only finishes once the broker is ready, so the backend is only asked while the broker is still in progress
+    if (status.get("deployment") or dict()).get("status") != "finished" and not backend.broker_ready(broker_namespace, broker_name):
+        wait_for("Waiting for broker to become ready.")
     return backend, backend_name, status["broker_name"], broker_object.get("spec", dict()).get("allowedK8sNamespaces", [])
+
+
+def broker_teardown_in_progress(backend, broker_namespace, broker_name):
+    """Checks if the AMQPBroker is being deleted in a way that also removes all its entities in the backend, in that case entities do not need to be deleted individually"""
+    if not backend.broker_delete_cascades():
+        return False
+    broker_object = get_namespaced_custom_object(k8s.AMQPBroker, broker_namespace, broker_name)
+    if not broker_object:
+        return not backend.broker_exists(broker_namespace, broker_name)
+    return k8s.marked_for_deletion(broker_object)
+
+
+def parent_broker_ref(parent_type, parent_namespace, parent_name):
+    parent_object = get_namespaced_custom_object(parent_type, parent_namespace, parent_name)
+    if not parent_object:
+        return None, None
+    return k8s.broker_ref(parent_namespace, parent_object["spec"], parent_object.get("status")) or (None, None)
+
+
+def _ref(obj, ref_field):
+    ref = obj["spec"][ref_field]
+    return (ref.get("namespace", obj["metadata"]["namespace"]), ref["name"])
+
+
+def _broker_ref(obj):
+    return k8s.broker_ref(obj["metadata"]["namespace"], obj["spec"], obj.get("status"))
+
+
+def resolve_broker_ref(resource, namespace, name, spec, status):
+    """Returns namespace and name of the AMQPBroker of a topic or queue. For objects referencing an AMQPBrokerPool a member
+       of the pool is chosen on the first run and recorded in the status so the object stays on it"""
+    broker_ref = k8s.broker_ref(namespace, spec, status)
+    if broker_ref:
+        return broker_ref
+    pool_ref = spec.get("brokerPoolRef")
+    if not pool_ref:
+        raise kopf.PermanentError("Either brokerRef or brokerPoolRef must be set")
+    with _placement_lock:
+        broker_namespace, broker_name = _select_pool_broker(pool_ref.get("namespace", namespace), pool_ref["name"], namespace)
+        patch_namespaced_custom_object_status(resource, namespace, name, {"broker_ref": {"namespace": broker_namespace, "name": broker_name}})
+    return broker_namespace, broker_name
+
+
+def _usable_from(broker_object, namespace):
+    """Applies the cross-namespace rules the topic and queue handlers check after placement, so no broker is chosen that the object may not use"""
+    if broker_object["metadata"]["namespace"] == namespace:
+        return True
+    if not config_get("cross_namespace.allow_produce", default=False):
+        return False
+    return namespace in broker_object.get("spec", dict()).get("allowedK8sNamespaces", [])
+
+
+def _select_pool_broker(pool_namespace, pool_name, namespace):
+    pool_object = get_namespaced_custom_object(k8s.AMQPBrokerPool, pool_namespace, pool_name)
+    if not pool_object:
+        wait_for("Waiting for broker pool object to be created.")
+    ready_brokers = []
+    for member in pool_object["spec"].get("brokers", []):
+        broker_object = get_namespaced_custom_object(k8s.AMQPBroker, member.get("namespace", pool_namespace), member["name"])
+        if not broker_object or k8s.marked_for_deletion(broker_object) or not _usable_from(broker_object, namespace):
+            continue
+        if ((broker_object.get("status") or dict()).get("deployment") or dict()).get("status") == "finished":
+            ready_brokers.append((member.get("namespace", pool_namespace), member["name"]))
+    if not ready_brokers:
+        wait_for("Waiting for a broker of the pool to be ready that can be used from this namespace.")
+    loads = _broker_loads(ready_brokers)
+    max_entities = pool_object["spec"].get("maxEntitiesPerBroker")
+    candidates = [broker for broker in ready_brokers if not max_entities or loads[broker][0] < max_entities]
+    if not candidates:
+        wait_for("All brokers of the pool have reached maxEntitiesPerBroker.")
+    return min(candidates, key=lambda broker: loads[broker])
+
+
+def _broker_loads(brokers):
+    """Load of each broker as (number of topics and queues, number of waiting messages of its queues and subscriptions from the collected metrics)"""
+    entity_counts = {broker: 0 for broker in brokers}
+    waiting_messages = {broker: 0 for broker in brokers}
+    topic_brokers = dict()
+
+    def _waiting(obj):
+        return ((obj.get("status") or dict()).get("metrics") or dict()).get("active", 0)
+    for resource in [k8s.AMQPTopic, k8s.AMQPQueue]:
+        for obj in k8s.list_custom_objects(resource):
+            broker = _broker_ref(obj)
+            if resource == k8s.AMQPTopic:
+                topic_brokers[(obj["metadata"]["namespace"], obj["metadata"]["name"])] = broker
+            if broker in entity_counts:
+                entity_counts[broker] += 1
+                waiting_messages[broker] += _waiting(obj)
+    for obj in k8s.list_custom_objects(k8s.AMQPTopicSubscription):
+        broker = topic_brokers.get(_ref(obj, "topicRef"))
+        if broker in waiting_messages:
+            waiting_messages[broker] += _waiting(obj)
+    return {broker: (entity_counts[broker], waiting_messages[broker]) for broker in brokers}
+
+
+def broker_children(broker_namespace, broker_name):
+    """Collects all topics, queues, subscriptions and consumers that belong to the AMQPBroker"""
+    return children_by_broker().get((broker_namespace, broker_name), _empty_children())
+
+
+def deployable_broker_children(broker_namespace, broker_name):
+    """Children of the AMQPBroker that are provisioned together with it. Objects being deleted are left out, as are the subscriptions
+       and consumers of topics and queues being deleted, which would otherwise depend on entities missing from the deployment"""
+    children = broker_children(broker_namespace, broker_name)
+    deployable = _empty_children()
+    for parent_key, child_key, child_ref_field in [("topics", "subscriptions", "topicRef"), ("queues", "consumers", "queueRef")]:
+        deleted_parents = set()
+        for obj in children[parent_key]:
+            if k8s.marked_for_deletion(obj):
+                deleted_parents.add((obj["metadata"]["namespace"], obj["metadata"]["name"]))
+            else:
+                deployable[parent_key].append(obj)
+        for obj in children[child_key]:
+            if not k8s.marked_for_deletion(obj) and _ref(obj, child_ref_field) not in deleted_parents:
+                deployable[child_key].append(obj)
+    return deployable
+
+
+def provisioned_with_broker(status, spec, broker_name):
+    """Returns the name of the entity if the combined deployment of the broker created it for the current spec of the object, otherwise None"""
+    provisioned = (status or dict()).get("provisioned") or dict()
+    if provisioned.get("broker_name") != broker_name or provisioned.get("specHash") != k8s.spec_hash(spec):
+        return None
+    return provisioned.get("entity")
+
+
+def _empty_children():
+    return {"topics": [], "subscriptions": [], "queues": [], "consumers": []}
+
+
+def children_by_broker():
+    """Collects the topics, queues, subscriptions and consumers of all AMQPBrokers with one list call per type, keyed by (namespace, name) of the broker"""
+    children = dict()
+    for parent_type, parent_key, child_type, child_key, child_ref_field in [(k8s.AMQPTopic, "topics", k8s.AMQPTopicSubscription, "subscriptions", "topicRef"), (k8s.AMQPQueue, "queues", k8s.AMQPQueueConsumer, "consumers", "queueRef")]:
+        parent_brokers = dict()
+        for obj in k8s.list_custom_objects(parent_type):
+            broker = _broker_ref(obj)
+            if not broker:
+                continue
+            parent_brokers[(obj["metadata"]["namespace"], obj["metadata"]["name"])] = broker
+            children.setdefault(broker, _empty_children())[parent_key].append(obj)
+        for obj in k8s.list_custom_objects(child_type):
+            broker = parent_brokers.get(_ref(obj, child_ref_field))
+            if broker:
+                children[broker][child_key].append(obj)
+    return children
+
+
+def credentials_rule_users(resource, broker_name, credentials_rule, exclude=None):
+    """Lists the objects whose credentials are derived from the given shared authorization rule, except the excluded (namespace, name) and objects being deleted"""
+    users = []
+    for obj in k8s.list_custom_objects(resource):
+        status = obj.get("status") or dict()
+        if status.get("broker_name") != broker_name or status.get("credentials_rule") != credentials_rule:
+            continue
+        if (obj["metadata"]["namespace"], obj["metadata"]["name"]) == exclude or k8s.marked_for_deletion(obj):
+            continue
+        users.append(obj)
+    return users
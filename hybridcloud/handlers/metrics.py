@@ -0,0 +1,77 @@
+import threading
+import time
+import kopf
+from hybridcloud_core.configuration import config_get
+from hybridcloud_core.k8s.api import patch_namespaced_custom_object_status
+from .routing import amqp_backend
+from .helpers import children_by_broker
+from ..util import k8s, metrics
+
+
+_INTERVAL = float(config_get("metrics.interval_seconds", default=60))
+# The timers of all brokers share one listing of the child objects per interval
+_children = (0.0, dict())
+_children_lock = threading.Lock()
+
+
+if metrics.enabled():
+    @kopf.timer(*k8s.AMQPBroker.kopf_on(), interval=_INTERVAL, initial_delay=float(config_get("metrics.initial_delay_seconds", default=30)), **k8s.watch_filters())
+    def broker_collect_metrics(name, namespace, status, logger, **kwargs):
+        if not status or "broker_name" not in status or "backend" not in status:
+            return
+        collect_metrics(namespace, name, status["backend"], status["broker_name"], logger)
+
+    @kopf.on.delete(*k8s.AMQPBroker.kopf_on(), optional=True, **k8s.watch_filters())
+    def broker_remove_metrics(name, namespace, **kwargs):
+        metrics.publish((namespace, name), [])
+
+
+def _broker_children(namespace, name):
+    global _children
+    with _children_lock:
+        listed_at, children = _children
+        if time.monotonic() - listed_at >= _INTERVAL / 2:
+            children = children_by_broker()
+            _children = (time.monotonic(), children)
+    return children.get((namespace, name)) or {"queues": [], "subscriptions": []}
+
+
+def collect_metrics(namespace, name, backend_name, broker_name, logger):
+    """Fetches the message counts of all queues and subscriptions of a broker in one batch and publishes them to the status of the objects and to prometheus"""
+    children = _broker_children(namespace, name)
+    entities = []
+    for obj in children["queues"]:
+        status = obj.get("status") or dict()
+        if status.get("queue_name"):
+            entities.append((k8s.AMQPQueue, obj, status.get("queue_name")))
+    for obj in children["subscriptions"]:
+        status = obj.get("status") or dict()
+        if status.get("topic_name") and status.get("subscription_name"):
+            entities.append((k8s.AMQPTopicSubscription, obj, (status["topic_name"], status["subscription_name"])))
+    if not entities:
+        metrics.publish((namespace, name), [])
+        return
+
+    backend = amqp_backend(backend_name, logger)
+    counts = backend.message_counts(
+        broker_name,
+        [entity for kind, _, entity in entities if kind == k8s.AMQPQueue],
+        [entity for kind, _, entity in entities if kind == k8s.AMQPTopicSubscription],
+    )
+
+    samples = []
+    for kind, obj, entity in entities:
+        if entity not in counts:
+            continue
+        obj_namespace, obj_name = obj["metadata"]["namespace"], obj["metadata"]["name"]
+        samples.append(({
+            "kind": obj["kind"],
+            "namespace": obj_namespace,
+            "name": obj_name,
+            "broker": broker_name,
+            "entity": entity if isinstance(entity, str) else "/".join(entity),
+        }, counts[entity]))
+        # Only write the status if the counts changed to not trigger needless watch events
+        if (obj.get("status") or dict()).get("metrics") != counts[entity]:
+            patch_namespaced_custom_object_status(kind, obj_namespace, obj_name, {"metrics": counts[entity]})
+    metrics.publish((namespace, name), samples)
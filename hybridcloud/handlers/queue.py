@@ -3,50 +3,77 @@ import kopf
 from .routing import amqp_backend
 from hybridcloud_core.configuration import config_get
 from hybridcloud_core.operator.reconcile_helpers import ignore_control_label_change, process_action_label
-from hybridcloud_core.k8s.api import patch_namespaced_custom_object_status, create_or_update_secret, get_secret, delete_secret
+from hybridcloud_core.k8s.api import patch_namespaced_custom_object_status
 from ..util import k8s
 from ..util.constants import BACKOFF
-from .helpers import wait_for_amqp_broker
+from ..util.journal import Journal, clear_journal
+from ..util.profiling import profiled
+from ..util.timings import PhaseTimings, VALIDATION, ENTITY, CREDENTIALS, SECRET
+from ..util.executors import dispatched, undispatched, run_dispatched, ENTITIES
+from ..util.retry import retry_policy
+from ..util.startup import defer_resume
+from ..util.secrets import credentials_secret_exists, write_credentials_secret, delete_credentials_secret
+from ..util.concurrency import run_parallel
+from .helpers import wait_for_amqp_broker, broker_teardown_in_progress, resolve_broker_ref, provisioned_with_broker
 
 
 if config_get("handler_on_resume", default=False):
-    @kopf.on.resume(*k8s.AMQPQueue.kopf_on(), backoff=BACKOFF)
-    def queue_resume(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs):
-        queue_manage(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs)
+    @kopf.on.resume(*k8s.AMQPQueue.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+    async def queue_resume(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs):
+        await defer_resume(status, retry)
+        await run_dispatched(ENTITIES, undispatched(queue_manage), spec=spec, meta=meta, labels=labels, name=name, namespace=namespace, body=body, status=status, retry=retry, diff=diff, logger=logger, **kwargs)
 
 
-@kopf.on.create(*k8s.AMQPQueue.kopf_on(), backoff=BACKOFF)
-@kopf.on.update(*k8s.AMQPQueue.kopf_on(), backoff=BACKOFF)
+@kopf.on.create(*k8s.AMQPQueue.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+@kopf.on.update(*k8s.AMQPQueue.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+@dispatched(ENTITIES)
+@retry_policy
+@profiled
 def queue_manage(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs):
     if ignore_control_label_change(diff):
         logger.debug("Only control labels removed. Nothing to do.")
         return
 
+    timings = PhaseTimings(body["kind"], meta, kwargs.get("started"))
+
     # Wait for broker
-    broker_namespace = spec["brokerRef"].get("namespace", namespace)
-    backend, backend_name, broker_name, allowed_k8s_namespaces = wait_for_amqp_broker(logger, broker_namespace, spec["brokerRef"]["name"], retry)
+    broker_namespace, broker_ref_name = resolve_broker_ref(k8s.AMQPQueue, namespace, name, spec, status)
+    backend, backend_name, broker_name, allowed_k8s_namespaces = wait_for_amqp_broker(logger, broker_namespace, broker_ref_name)
+    timings.waited()
 
     # Check for cross-namespace
     if broker_namespace != namespace:
         if not config_get("cross_namespace.allow_produce", default=False):
-            _status(name, namespace, status, "failed", f"AMQPBroker and AMQPQueue in different k8s namespaces is not allowed")
+            _status(name, namespace, status, "failed", f"AMQPBroker and AMQPQueue in different k8s namespaces is not allowed", timings=timings)
             raise kopf.PermanentError("AMQPBroker and AMQPQueue in different k8s namespaces is not allowed")
         if not namespace in allowed_k8s_namespaces:
-            _status(name, namespace, status, "failed", f"Your k8s namespace is not allowed to use the referenced AMQPBroker")
+            _status(name, namespace, status, "failed", f"Your k8s namespace is not allowed to use the referenced AMQPBroker", timings=timings)
             raise kopf.PermanentError(f"Your k8s namespace is not allowed to use the referenced AMQPBroker")  
 
-    # Validate spec
-    valid, reason = backend.queue_spec_valid(namespace, name, spec, broker_name)
-    if not valid:
-        _status(name, namespace, status, "failed", f"Validation failed: {reason}")
-        raise kopf.PermanentError("Spec is invalid, check status for details")
+    # Entities created by the combined deployment of the broker for their current spec are neither validated nor updated again
+    provisioned = provisioned_with_broker(status, spec, broker_name)
 
+    # Validate spec
+    if not provisioned:
+        with timings.phase(VALIDATION):
+            valid, reason = backend.queue_spec_valid(namespace, name, spec, broker_name)
+        if not valid:
+            _status(name, namespace, status, "failed", f"Validation failed: {reason}", timings=timings)
+            raise kopf.PermanentError("Spec is invalid, check status for details")
+
+    journal = Journal(k8s.AMQPQueue, namespace, name, spec, status)
     _status(name, namespace, status, "working", backend=backend_name, broker_name=broker_name)
 
-    # Create queue
-    queue_name = backend.create_or_update_queue(namespace, name, spec, broker_name)
-
-    credentials_secret = get_secret(namespace, spec["credentialsSecret"])
+    # Create queue and fetch existing credentials concurrently
+    def create_queue():
+        if provisioned:
+            return provisioned
+        with timings.phase(ENTITY):
+            return journal.run("entity", lambda: backend.create_or_update_queue(namespace, name, spec, broker_name))
+    queue_name, credentials_secret = run_parallel(
+        create_queue,
+        lambda: credentials_secret_exists(namespace, spec["credentialsSecret"]),
+    )
     reset_credentials = False
 
     def action_reset_credentials():
@@ -61,14 +88,18 @@ def queue_manage(spec, meta, labels, name, namespace, body, status, retry, diff,
 
     # Generate credentials
     if not credentials_secret:
-        credentials = backend.create_or_update_queue_credentials(queue_name, broker_name, reset_credentials)
-        create_or_update_secret(namespace, spec["credentialsSecret"], credentials)
+        with timings.phase(CREDENTIALS):
+            credentials = backend.create_or_update_queue_credentials(queue_name, broker_name, reset_credentials)
+        with timings.phase(SECRET):
+            write_credentials_secret(namespace, spec["credentialsSecret"], credentials)
 
     # mark success
-    _status(name, namespace, status, "finished", "Queue created", backend=backend_name, broker_name=broker_name, queue_name=queue_name)
+    _status(name, namespace, status, "finished", "Queue created", backend=backend_name, broker_name=broker_name, queue_name=queue_name, timings=timings)
 
 
-@kopf.on.delete(*k8s.AMQPQueue.kopf_on(), backoff=BACKOFF)
+@kopf.on.delete(*k8s.AMQPQueue.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+@dispatched(ENTITIES)
+@retry_policy
 def queue_delete(spec, status, name, namespace, logger, **kwargs):
     if status and "backend" in status:
         backend_name = status["backend"]
@@ -80,13 +111,18 @@ def queue_delete(spec, status, name, namespace, logger, **kwargs):
         return
     broker_name = status["broker_name"]
 
-    delete_secret(namespace, spec["credentialsSecret"])
+    delete_credentials_secret(namespace, spec["credentialsSecret"])
+
+    broker_ref = k8s.broker_ref(namespace, spec, status)
+    if broker_ref and broker_teardown_in_progress(backend, *broker_ref):
+        logger.info("Broker is being deleted, queue will be removed with it")
+        return
 
     if backend.queue_exists(namespace, name, broker_name):
         backend.delete_queue(namespace, name, broker_name)
 
 
-def _status(name, namespace, status_obj, status, reason=None, backend=None, broker_name=None, queue_name=None):
+def _status(name, namespace, status_obj, status, reason=None, backend=None, broker_name=None, queue_name=None, timings=None):
     if status_obj:
         new_status = dict()
         for k, v in status_obj.items():
@@ -100,6 +136,10 @@ def _status(name, namespace, status_obj, status, reason=None, backend=None, brok
         status_obj["broker_name"] = broker_name
     if queue_name:
         status_obj["queue_name"] = queue_name
+    if status == "finished":
+        clear_journal(status_obj)
+        if timings:
+            status_obj["timings"] = timings.status(status_obj.get("timings"))
     status_obj["deployment"] = {
         "status": status,
         "reason": reason,
@@ -3,47 +3,65 @@ import kopf
 from .routing import amqp_backend
 from hybridcloud_core.configuration import config_get
 from hybridcloud_core.operator.reconcile_helpers import ignore_control_label_change, process_action_label
-from hybridcloud_core.k8s.api import get_namespaced_custom_object, patch_namespaced_custom_object_status, create_or_update_secret, get_secret, delete_secret
+from hybridcloud_core.k8s.api import get_namespaced_custom_object, patch_namespaced_custom_object_status
 from ..util import k8s
 from ..util.constants import BACKOFF
+from ..util.profiling import profiled
+from ..util.timings import PhaseTimings, VALIDATION, CREDENTIALS, SECRET
+from ..util.executors import dispatched, undispatched, run_dispatched, CREDENTIALS as CREDENTIALS_POOL
+from ..util.retry import retry_policy, wait_for
+from ..util.startup import defer_resume
+from ..util.secrets import credentials_secret_exists, write_credentials_secret, delete_credentials_secret
+from .helpers import broker_teardown_in_progress, parent_broker_ref, credentials_rule_users
 
 
 if config_get("handler_on_resume", default=False):
-    @kopf.on.resume(*k8s.AMQPQueueConsumer.kopf_on(), backoff=BACKOFF)
-    def queue_consumer_resume(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs):
-        queue_consumer_manage(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs)
+    @kopf.on.resume(*k8s.AMQPQueueConsumer.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+    async def queue_consumer_resume(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs):
+        await defer_resume(status, retry)
+        await run_dispatched(CREDENTIALS_POOL, undispatched(queue_consumer_manage), spec=spec, meta=meta, labels=labels, name=name, namespace=namespace, body=body, status=status, retry=retry, diff=diff, logger=logger, **kwargs)
 
 
-@kopf.on.create(*k8s.AMQPQueueConsumer.kopf_on(), backoff=BACKOFF)
-@kopf.on.update(*k8s.AMQPQueueConsumer.kopf_on(), backoff=BACKOFF)
+@kopf.on.create(*k8s.AMQPQueueConsumer.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+@kopf.on.update(*k8s.AMQPQueueConsumer.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+@dispatched(CREDENTIALS_POOL)
+@retry_policy
+@profiled
 def queue_consumer_manage(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs):
     if ignore_control_label_change(diff):
         logger.debug("Only control labels removed. Nothing to do.")
         return
 
+    timings = PhaseTimings(body["kind"], meta, kwargs.get("started"))
+
     # Wait for queue
     queue_namespace = spec["queueRef"].get("namespace", namespace)
-    backend, backend_name, broker_name, queue_name, allowed_k8s_namespaces = _wait_for_queue(logger, queue_namespace, spec["queueRef"]["name"], retry)
+    backend, backend_name, broker_name, queue_name, allowed_k8s_namespaces = _wait_for_queue(logger, queue_namespace, spec["queueRef"]["name"])
+    timings.waited()
 
     # Check for cross-namespace
     if queue_namespace != namespace:
         if not config_get("cross_namespace.allow_consume", default=False):
-            _status(name, namespace, status, "failed", "Queue and Consumer in different k8s namespaces is not allowed")
+            _status(name, namespace, status, "failed", "Queue and Consumer in different k8s namespaces is not allowed", timings=timings)
             raise kopf.PermanentError("Queue and Consumer in different k8s namespaces is not allowed")
         if not namespace in allowed_k8s_namespaces:
-            _status(name, namespace, status, "failed", "Your k8s namespace is not allowed to use the referenced AMQPQueue")
+            _status(name, namespace, status, "failed", "Your k8s namespace is not allowed to use the referenced AMQPQueue", timings=timings)
             raise kopf.PermanentError(f"Your k8s namespace is not allowed to use the referenced AMQPQueue")  
 
     # Validate spec
-    valid, reason = backend.queue_consumer_spec_valid(namespace, name, spec)
+    with timings.phase(VALIDATION):
+        valid, reason = backend.queue_consumer_spec_valid(namespace, name, spec)
     if not valid:
-        _status(name, namespace, status, "failed", f"Validation failed: {reason}")
+        _status(name, namespace, status, "failed", f"Validation failed: {reason}", timings=timings)
         raise kopf.PermanentError("Spec is invalid, check status for details")
 
     _status(name, namespace, status, "working", backend=backend_name, queue_name=queue_name, broker_name=broker_name)
 
+    # The existing secret stays on the rule it was issued from, None is the own rule of the consumer
+    issued_rule = (status or dict()).get("credentials_rule")
+    credentials_rule = issued_rule
 
-    credentials_secret = get_secret(namespace, spec["credentialsSecret"])
+    credentials_secret = credentials_secret_exists(namespace, spec["credentialsSecret"])
     reset_credentials = False
 
     def action_reset_credentials():
@@ -58,14 +76,30 @@ def queue_consumer_manage(spec, meta, labels, name, namespace, body, status, ret
 
     # Generate credentials
     if not credentials_secret:
-        credentials = backend.create_or_update_queue_consumer_credentials(namespace, name, queue_name, broker_name, reset_credentials)
-        create_or_update_secret(namespace, spec["credentialsSecret"], credentials)
+        # Only newly issued credentials move to the rule of the configured strategy
+        credentials_rule = backend.queue_consumer_credentials_rule(namespace, name, queue_name)
+        with timings.phase(CREDENTIALS):
+            credentials = backend.create_or_update_queue_consumer_credentials(namespace, name, queue_name, broker_name, reset_credentials, credentials_rule=credentials_rule)
+        with timings.phase(SECRET):
+            write_credentials_secret(namespace, spec["credentialsSecret"], credentials)
+        if reset_credentials and credentials_rule:
+            # The key of the shared rule was regenerated so the tokens of all other consumers using it are invalid now
+            for obj in credentials_rule_users(k8s.AMQPQueueConsumer, broker_name, credentials_rule, exclude=(namespace, name)):
+                obj_namespace, obj_name = obj["metadata"]["namespace"], obj["metadata"]["name"]
+                write_credentials_secret(obj_namespace, obj["spec"]["credentialsSecret"], backend.create_or_update_queue_consumer_credentials(obj_namespace, obj_name, queue_name, broker_name, credentials_rule=credentials_rule))
+        if k8s.credentials_issued(status) and issued_rule != credentials_rule:
+            if issued_rule and credentials_rule_users(k8s.AMQPQueueConsumer, broker_name, issued_rule, exclude=(namespace, name)):
+                logger.info(f"Shared authorization rule {issued_rule} is still used by other consumers")
+            else:
+                backend.delete_queue_consumer_credentials(namespace, name, queue_name, broker_name, credentials_rule=issued_rule)
 
     # mark success
-    _status(name, namespace, status, "finished", "QueueConsumer created", backend=backend_name, broker_name=broker_name, queue_name=queue_name)
+    _status(name, namespace, status, "finished", "QueueConsumer created", backend=backend_name, broker_name=broker_name, queue_name=queue_name, credentials_rule=credentials_rule, timings=timings)
 
 
-@kopf.on.delete(*k8s.AMQPQueueConsumer.kopf_on(), backoff=BACKOFF)
+@kopf.on.delete(*k8s.AMQPQueueConsumer.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+@dispatched(CREDENTIALS_POOL)
+@retry_policy
 def queue_consumer_delete(spec, status, name, namespace, logger, **kwargs):
     if status and "backend" in status:
         backend_name = status["backend"]
@@ -78,11 +112,21 @@ def queue_consumer_delete(spec, status, name, namespace, logger, **kwargs):
     broker_name = status["broker_name"]
     queue_name = status["queue_name"]
 
-    delete_secret(namespace, spec["credentialsSecret"])
-    backend.delete_queue_consumer_credentials(namespace, name, queue_name, broker_name)
+    delete_credentials_secret(namespace, spec["credentialsSecret"])
+
+    broker_ref_namespace, broker_ref_name = parent_broker_ref(k8s.AMQPQueue, spec["queueRef"].get("namespace", namespace), spec["queueRef"]["name"])
+    if broker_ref_name and broker_teardown_in_progress(backend, broker_ref_namespace, broker_ref_name):
+        logger.info("Broker is being deleted, queue consumer credentials will be removed with it")
+        return
+
+    credentials_rule = status.get("credentials_rule")
+    if credentials_rule and credentials_rule_users(k8s.AMQPQueueConsumer, broker_name, credentials_rule, exclude=(namespace, name)):
+        logger.info(f"Shared authorization rule {credentials_rule} is still used by other consumers")
+        return
+    backend.delete_queue_consumer_credentials(namespace, name, queue_name, broker_name, credentials_rule=credentials_rule)
 
 
-def _status(name, namespace, status_obj, status, reason=None, backend=None, broker_name=None, queue_name=None):
+def _status(name, namespace, status_obj, status, reason=None, backend=None, broker_name=None, queue_name=None, credentials_rule=None, timings=None):
     if status_obj:
         new_status = dict()
         for k, v in status_obj.items():
@@ -96,6 +140,11 @@ def _status(name, namespace, status_obj, status, reason=None, backend=None, brok
         status_obj["broker_name"] = broker_name
     if queue_name:
         status_obj["queue_name"] = queue_name
+    if status == "finished":
+        # None means the credentials were issued from the own rule of the consumer
+        status_obj["credentials_rule"] = credentials_rule
+    if timings and status == "finished":
+        status_obj["timings"] = timings.status(status_obj.get("timings"))
     status_obj["deployment"] = {
         "status": status,
         "reason": reason,
@@ -104,19 +153,19 @@ def _status(name, namespace, status_obj, status, reason=None, backend=None, brok
     patch_namespaced_custom_object_status(k8s.AMQPQueueConsumer, namespace, name, status_obj)
 
 
-def _wait_for_queue(logger, queue_namespace, queue_name, retry):
+def _wait_for_queue(logger, queue_namespace, queue_name):
     queue_object = get_namespaced_custom_object(k8s.AMQPQueue, queue_namespace, queue_name)
     if not queue_object:
-        raise kopf.TemporaryError("Waiting for queue to be created.", delay=10 if retry < 5 else 20 if retry < 10 else 30)
+        wait_for("Waiting for queue to be created.")
 
     status = queue_object.get("status")
     if not status or not "broker_name" in status or not "queue_name" in status:
-        raise kopf.TemporaryError("Waiting for queue to be created.", delay=10 if retry < 5 else 20 if retry < 10 else 30)
+        wait_for("Waiting for queue to be created.")
     backend_name = status.get("backend", queue_object.get("spec", dict()).get("backend", config_get("backend", fail_if_missing=True)))
     backend = amqp_backend(backend_name, logger)
     broker_name = status["broker_name"]
 
     queue_exists = backend.queue_exists(queue_namespace, queue_name, broker_name)
     if not queue_exists:
-        raise kopf.TemporaryError("Waiting for queue to be created.", delay=10 if retry < 5 else 20 if retry < 10 else 30)
+        wait_for("Waiting for queue to be created.")
     return backend, backend_name, status["broker_name"], status["queue_name"], queue_object["spec"].get("allowedK8sNamespaces", [])
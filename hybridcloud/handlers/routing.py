@@ -1,22 +1,65 @@
-from ..backends.azureservicebus import AzureServiceBusBackend
-from ..backends.rabbitmq import RabbitMQBackend
+import importlib
+import time
 from hybridcloud_core.configuration import config_get, ConfigurationException
 
 
+# Backends are only imported on first use so the operator does not pay for the azure sdk or requests if they are not configured
 _backends = {
-    "azureservicebus": AzureServiceBusBackend,
-    "rabbitmq": RabbitMQBackend,
+    "azureservicebus": ("hybridcloud.backends.azureservicebus", "AzureServiceBusBackend"),
+    "rabbitmq": ("hybridcloud.backends.rabbitmq", "RabbitMQBackend"),
 }
+_loaded_backends = dict()
+_load_timings = dict()
 
 
-def amqp_backend(selected_backend, logger) -> AzureServiceBusBackend:
+def _backend_class(backend_name):
+    if backend_name not in _loaded_backends:
+        module_name, class_name = _backends[backend_name]
+        start = time.perf_counter()
+        module = importlib.import_module(module_name)
+        _load_timings[backend_name] = time.perf_counter() - start
+        _loaded_backends[backend_name] = getattr(module, class_name)
+    return _loaded_backends[backend_name]
+
+
+def configured_backends():
     backend = config_get("backend", fail_if_missing=True)
     if backend not in _backends.keys():
         raise ConfigurationException(f"Unknown backend: {backend}")
+    backends = [backend]
+    for allowed_backend in config_get("allowed_backends", default=[]) or []:
+        if allowed_backend not in _backends.keys():
+            raise ConfigurationException(f"Unknown backend in allowed_backends: {allowed_backend}")
+        if allowed_backend not in backends:
+            backends.append(allowed_backend)
+    return backends
+
+
+def preload_backends(logger):
+    """Imports and initializes all configured backends once and returns the time spent per backend in seconds"""
+    report = dict()
+    for backend_name in configured_backends():
+        _backend_class(backend_name)
+        start = time.perf_counter()
+        amqp_backend(backend_name, logger)
+        report[backend_name] = {
+            "import": _load_timings.get(backend_name, 0.0),
+            "init": time.perf_counter() - start,
+        }
+    return report
+
+
+def amqp_backend(selected_backend, logger):
+    backends = configured_backends()
+    backend = backends[0]
     if selected_backend:
         if selected_backend not in _backends.keys():
             logger.warn(f"Selected backend {selected_backend} is unknown. Defaulting to {backend}")
             selected_backend = backend
+        elif selected_backend not in backends:
+            # Only backends from backend and allowed_backends may be loaded
+            logger.warn(f"Selected backend {selected_backend} is not allowed. Defaulting to {backend}")
+            selected_backend = backend
     else:
         selected_backend = backend
-    return _backends[selected_backend](logger)
+    return _backend_class(selected_backend)(logger)
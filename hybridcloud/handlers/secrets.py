@@ -0,0 +1,11 @@
+import threading
+import kopf
+from ..util.k8s import listable_namespaces
+from ..util.secrets import watch_managed_secrets
+
+
+@kopf.on.startup()
+def watch_credentials_secrets(logger, **_):
+    # A plain watch instead of a kopf event handler: kopf filters labels on the client side and would receive every secret of the cluster
+    for namespace in listable_namespaces() or [None]:
+        threading.Thread(target=watch_managed_secrets, args=(logger, namespace), name=f"credentials-secrets-watch-{namespace or 'all'}", daemon=True).start()
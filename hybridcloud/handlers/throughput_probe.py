@@ -0,0 +1,90 @@
+import asyncio
+import contextvars
+import functools
+from datetime import datetime, timezone
+import kopf
+from hybridcloud_core.configuration import config_get
+from hybridcloud_core.k8s.api import get_namespaced_custom_object, patch_namespaced_custom_object_status
+from ..util import k8s
+from ..util.constants import BACKOFF
+from ..util.retry import retry_policy, wait_for
+from ..util.secrets import read_credentials_secret
+from ..util.throughput import run_probe, probe_executor, ProbeError
+
+
+@kopf.on.create(*k8s.AMQPThroughputProbe.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+@kopf.on.update(*k8s.AMQPThroughputProbe.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+async def throughput_probe_run(**kwargs):
+    # A probe blocks for up to max_duration_seconds, so it runs in the pool of the probes instead of a thread of kopf
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(probe_executor(), context.run, functools.partial(throughput_probe_execute, **kwargs))
+
+
+@retry_policy
+def throughput_probe_execute(spec, name, namespace, status, logger, **kwargs):
+    if "queueRef" in spec:
+        target_type, target_name, is_queue = k8s.AMQPQueue, spec["queueRef"]["name"], True
+    elif "topicRef" in spec:
+        target_type, target_name, is_queue = k8s.AMQPTopic, spec["topicRef"]["name"], False
+    else:
+        _status(name, namespace, status, "failed", "Either queueRef or topicRef must be set")
+        raise kopf.PermanentError("Either queueRef or topicRef must be set")
+
+    messages = int(spec.get("messages", 1000))
+    max_messages = int(config_get("throughput_probe.max_messages", default=10000))
+    if messages > max_messages:
+        _status(name, namespace, status, "failed", f"Validation failed: at most {max_messages} messages are allowed")
+        raise kopf.PermanentError("Spec is invalid, check status for details")
+    timeout = min(float(spec.get("timeoutSeconds", 60)), float(config_get("throughput_probe.max_duration_seconds", default=120)))
+    if not is_queue:
+        subscriptions = _topic_subscriptions(namespace, target_name)
+        if subscriptions:
+            # Every subscription of the topic would receive the probe messages
+            _status(name, namespace, status, "failed", f"Validation failed: the topic has {len(subscriptions)} subscriptions that would receive the probe messages")
+            raise kopf.PermanentError("Spec is invalid, check status for details")
+
+    # Wait for the entity and its credentials, the probe only works with objects in its own namespace
+    target_object = get_namespaced_custom_object(target_type, namespace, target_name)
+    if not target_object:
+        wait_for("Waiting for the referenced object to be created.")
+    if ((target_object.get("status") or dict()).get("deployment") or dict()).get("status") != "finished":
+        wait_for("Waiting for the referenced object to be finished.")
+    credentials = read_credentials_secret(namespace, target_object["spec"]["credentialsSecret"])
+    if not credentials:
+        wait_for("Waiting for the credentials secret of the referenced object.")
+
+    _status(name, namespace, status, "working")
+    logger.info(f"Running throughput probe with {messages} messages")
+    try:
+        result = run_probe(credentials, is_queue, messages, int(spec.get("messageSizeBytes", 1024)), timeout, config_get("throughput_probe.hostname", default=None))
+    except ProbeError as e:
+        _status(name, namespace, status, "failed", str(e))
+        raise kopf.PermanentError(str(e))
+    _status(name, namespace, status, "finished", "Probe finished", result=result)
+
+
+def _topic_subscriptions(namespace, topic_name):
+    subscriptions = []
+    for obj in k8s.list_custom_objects(k8s.AMQPTopicSubscription):
+        ref = obj["spec"]["topicRef"]
+        if (ref.get("namespace", obj["metadata"]["namespace"]), ref["name"]) == (namespace, topic_name):
+            subscriptions.append(obj)
+    return subscriptions
+
+
+def _status(name, namespace, status_obj, status, reason=None, result=None):
+    if status_obj:
+        new_status = dict()
+        for k, v in status_obj.items():
+            new_status[k] = v
+        status_obj = new_status
+    else:
+        status_obj = dict()
+    if result:
+        status_obj["result"] = result
+    status_obj["deployment"] = {
+        "status": status,
+        "reason": reason,
+        "latest-update": datetime.now(tz=timezone.utc).isoformat()
+    }
+    patch_namespaced_custom_object_status(k8s.AMQPThroughputProbe, namespace, name, status_obj)
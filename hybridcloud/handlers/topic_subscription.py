@@ -3,49 +3,80 @@ import kopf
 from .routing import amqp_backend
 from hybridcloud_core.configuration import config_get
 from hybridcloud_core.operator.reconcile_helpers import ignore_control_label_change, process_action_label
-from hybridcloud_core.k8s.api import get_namespaced_custom_object, patch_namespaced_custom_object_status, create_or_update_secret, get_secret, delete_secret
+from hybridcloud_core.k8s.api import get_namespaced_custom_object, patch_namespaced_custom_object_status
 from ..util import k8s
 from ..util.constants import BACKOFF
+from ..util.journal import Journal, clear_journal
+from ..util.profiling import profiled
+from ..util.timings import PhaseTimings, VALIDATION, ENTITY, CREDENTIALS, SECRET
+from ..util.executors import dispatched, undispatched, run_dispatched, ENTITIES
+from ..util.retry import retry_policy, wait_for
+from ..util.startup import defer_resume
+from ..util.secrets import credentials_secret_exists, write_credentials_secret, delete_credentials_secret
+from ..util.concurrency import run_parallel
+from .helpers import broker_teardown_in_progress, parent_broker_ref, credentials_rule_users, provisioned_with_broker
 
 
 if config_get("handler_on_resume", default=False):
-    @kopf.on.resume(*k8s.AMQPTopicSubscription.kopf_on(), backoff=BACKOFF)
-    def topic_subscription_resume(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs):
-        topic_subscription_manage(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs)
+    @kopf.on.resume(*k8s.AMQPTopicSubscription.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+    async def topic_subscription_resume(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs):
+        await defer_resume(status, retry)
+        await run_dispatched(ENTITIES, undispatched(topic_subscription_manage), spec=spec, meta=meta, labels=labels, name=name, namespace=namespace, body=body, status=status, retry=retry, diff=diff, logger=logger, **kwargs)
 
 
-@kopf.on.create(*k8s.AMQPTopicSubscription.kopf_on(), backoff=BACKOFF)
-@kopf.on.update(*k8s.AMQPTopicSubscription.kopf_on(), backoff=BACKOFF)
+@kopf.on.create(*k8s.AMQPTopicSubscription.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+@kopf.on.update(*k8s.AMQPTopicSubscription.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+@dispatched(ENTITIES)
+@retry_policy
+@profiled
 def topic_subscription_manage(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs):
     if ignore_control_label_change(diff):
         logger.debug("Only control labels removed. Nothing to do.")
         return
 
+    timings = PhaseTimings(body["kind"], meta, kwargs.get("started"))
+
     # Wait for topic
     topic_namespace = spec["topicRef"].get("namespace", namespace)
-    backend, backend_name, broker_name, topic_name, allowed_k8s_namespaces = _wait_for_topic(logger, topic_namespace, spec["topicRef"]["name"], retry)
+    backend, backend_name, broker_name, topic_name, allowed_k8s_namespaces = _wait_for_topic(logger, topic_namespace, spec["topicRef"]["name"])
+    timings.waited()
 
     # Check for cross-namespace
     if topic_namespace != namespace:
         if not config_get("cross_namespace.allow_consume", default=False):
-            _status(name, namespace, status, "failed", "Topic and Subscription in different k8s namespaces is not allowed")
+            _status(name, namespace, status, "failed", "Topic and Subscription in different k8s namespaces is not allowed", timings=timings)
             raise kopf.PermanentError("Topic and Subscription in different k8s namespaces is not allowed")
         if not namespace in allowed_k8s_namespaces:
-            _status(name, namespace, status, "failed", "Your k8s namespace is not allowed to use the referenced AMQPTopic")
+            _status(name, namespace, status, "failed", "Your k8s namespace is not allowed to use the referenced AMQPTopic", timings=timings)
             raise kopf.PermanentError(f"Your k8s namespace is not allowed to zse the referenced AMQPTopic")  
 
-    # Validate spec
-    valid, reason = backend.topic_subscription_spec_valid(namespace, name, spec)
-    if not valid:
-        _status(name, namespace, status, "failed", f"Validation failed: {reason}")
-        raise kopf.PermanentError("Spec is invalid, check status for details")
+    # Entities created by the combined deployment of the broker for their current spec are neither validated nor updated again
+    provisioned = provisioned_with_broker(status, spec, broker_name)
 
+    # Validate spec
+    if not provisioned:
+        with timings.phase(VALIDATION):
+            valid, reason = backend.topic_subscription_spec_valid(namespace, name, spec, topic_name, broker_name)
+        if not valid:
+            _status(name, namespace, status, "failed", f"Validation failed: {reason}", timings=timings)
+            raise kopf.PermanentError("Spec is invalid, check status for details")
+
+    journal = Journal(k8s.AMQPTopicSubscription, namespace, name, spec, status)
     _status(name, namespace, status, "working", backend=backend_name, topic_name=topic_name, broker_name=broker_name)
 
-    # Create topic subscription
-    subscription_name = backend.create_or_update_topic_subscription(namespace, name, spec, topic_name, broker_name)
-
-    credentials_secret = get_secret(namespace, spec["credentialsSecret"])
+    # Create topic subscription and fetch existing credentials concurrently
+    def create_subscription():
+        if provisioned:
+            return provisioned
+        with timings.phase(ENTITY):
+            return journal.run("entity", lambda: backend.create_or_update_topic_subscription(namespace, name, spec, topic_name, broker_name))
+    subscription_name, credentials_secret = run_parallel(
+        create_subscription,
+        lambda: credentials_secret_exists(namespace, spec["credentialsSecret"]),
+    )
+    # The existing secret stays on the rule it was issued from, None is the own rule of the subscription
+    issued_rule = (status or dict()).get("credentials_rule")
+    credentials_rule = issued_rule
     reset_credentials = False
 
     def action_reset_credentials():
@@ -60,14 +91,29 @@ def topic_subscription_manage(spec, meta, labels, name, namespace, body, status,
 
     # Generate credentials
     if not credentials_secret:
-        credentials = backend.create_or_update_topic_subscription_credentials(subscription_name, topic_name, broker_name, reset_credentials)
-        create_or_update_secret(namespace, spec["credentialsSecret"], credentials)
+        # Only newly issued credentials move to the rule of the configured strategy
+        credentials_rule = backend.topic_subscription_credentials_rule(subscription_name, topic_name)
+        with timings.phase(CREDENTIALS):
+            credentials = backend.create_or_update_topic_subscription_credentials(subscription_name, topic_name, broker_name, reset_credentials, credentials_rule=credentials_rule)
+        with timings.phase(SECRET):
+            write_credentials_secret(namespace, spec["credentialsSecret"], credentials)
+        if reset_credentials and credentials_rule:
+            # The key of the shared rule was regenerated so the tokens of all other subscriptions using it are invalid now
+            for obj in credentials_rule_users(k8s.AMQPTopicSubscription, broker_name, credentials_rule, exclude=(namespace, name)):
+                write_credentials_secret(obj["metadata"]["namespace"], obj["spec"]["credentialsSecret"], backend.create_or_update_topic_subscription_credentials(obj["status"]["subscription_name"], topic_name, broker_name, credentials_rule=credentials_rule))
+        if k8s.credentials_issued(status) and issued_rule != credentials_rule:
+            if issued_rule and credentials_rule_users(k8s.AMQPTopicSubscription, broker_name, issued_rule, exclude=(namespace, name)):
+                logger.info(f"Shared authorization rule {issued_rule} is still used by other subscriptions")
+            else:
+                backend.delete_topic_subscription_credentials(subscription_name, topic_name, broker_name, credentials_rule=issued_rule)
 
     # mark success
-    _status(name, namespace, status, "finished", "TopicSubscription created", backend=backend_name, broker_name=broker_name, topic_name=topic_name, subscription_name=subscription_name)
+    _status(name, namespace, status, "finished", "TopicSubscription created", backend=backend_name, broker_name=broker_name, topic_name=topic_name, subscription_name=subscription_name, credentials_rule=credentials_rule, timings=timings)
 
 
-@kopf.on.delete(*k8s.AMQPTopicSubscription.kopf_on(), backoff=BACKOFF)
+@kopf.on.delete(*k8s.AMQPTopicSubscription.kopf_on(), backoff=BACKOFF, **k8s.watch_filters())
+@dispatched(ENTITIES)
+@retry_policy
 def topic_subscription_delete(spec, status, name, namespace, logger, **kwargs):
     if status and "backend" in status:
         backend_name = status["backend"]
@@ -81,14 +127,26 @@ def topic_subscription_delete(spec, status, name, namespace, logger, **kwargs):
     topic_name = status["topic_name"]
     subscription_name = status["subscription_name"]
 
-    delete_secret(namespace, spec["credentialsSecret"])
+    delete_credentials_secret(namespace, spec["credentialsSecret"])
+
+    broker_ref_namespace, broker_ref_name = parent_broker_ref(k8s.AMQPTopic, spec["topicRef"].get("namespace", namespace), spec["topicRef"]["name"])
+    if broker_ref_name and broker_teardown_in_progress(backend, broker_ref_namespace, broker_ref_name):
+        logger.info("Broker is being deleted, topic subscription will be removed with it")
+        return
 
-    if backend.topic_subscription_exists(namespace, name, topic_name, broker_name):
-        backend.delete_topic_subscription(namespace, name, topic_name, broker_name)
-    backend.delete_topic_subscription_credentials(subscription_name, topic_name, broker_name)
+    def _delete_subscription():
+        if backend.topic_subscription_exists(namespace, name, topic_name, broker_name):
+            backend.delete_topic_subscription(namespace, name, topic_name, broker_name)
+    def _delete_credentials():
+        credentials_rule = status.get("credentials_rule")
+        if credentials_rule and credentials_rule_users(k8s.AMQPTopicSubscription, broker_name, credentials_rule, exclude=(namespace, name)):
+            logger.info(f"Shared authorization rule {credentials_rule} is still used by other subscriptions")
+            return
+        backend.delete_topic_subscription_credentials(subscription_name, topic_name, broker_name, credentials_rule=credentials_rule)
+    run_parallel(_delete_subscription, _delete_credentials)
 
 
-def _status(name, namespace, status_obj, status, reason=None, backend=None, broker_name=None, topic_name=None, subscription_name=None):
+def _status(name, namespace, status_obj, status, reason=None, backend=None, broker_name=None, topic_name=None, subscription_name=None, credentials_rule=None, timings=None):
     if status_obj:
         new_status = dict()
         for k, v in status_obj.items():
@@ -104,6 +162,12 @@ def _status(name, namespace, status_obj, status, reason=None, backend=None, brok
         status_obj["topic_name"] = topic_name
     if subscription_name:
         status_obj["subscription_name"] = subscription_name
+    if status == "finished":
+        # None means the credentials were issued from the own rule of the subscription
+        status_obj["credentials_rule"] = credentials_rule
+        clear_journal(status_obj)
+        if timings:
+            status_obj["timings"] = timings.status(status_obj.get("timings"))
     status_obj["deployment"] = {
         "status": status,
         "reason": reason,
@@ -112,19 +176,19 @@ def _status(name, namespace, status_obj, status, reason=None, backend=None, brok
     patch_namespaced_custom_object_status(k8s.AMQPTopicSubscription, namespace, name, status_obj)
 
 
-def _wait_for_topic(logger, topic_namespace, topic_name, retry):
+def _wait_for_topic(logger, topic_namespace, topic_name):
     topic_object = get_namespaced_custom_object(k8s.AMQPTopic, topic_namespace, topic_name)
     if not topic_object:
-        raise kopf.TemporaryError("Waiting for topic object to be created.", delay=10 if retry < 5 else 20 if retry < 10 else 30)
+        wait_for("Waiting for topic object to be created.")
 
     status = topic_object.get("status")
     if not status or not "broker_name" in status or not "topic_name" in status:
-        raise kopf.TemporaryError("Waiting for topic to be created by backend.", delay=10 if retry < 5 else 20 if retry < 10 else 30)
+        wait_for("Waiting for topic to be created by backend.")
     backend_name = status.get("backend", topic_object.get("spec", dict()).get("backend", config_get("backend", fail_if_missing=True)))
     backend = amqp_backend(backend_name, logger)
     broker_name = status["broker_name"]
 
     topic_exists = backend.topic_exists(topic_namespace, topic_name, broker_name)
     if not topic_exists:
-        raise kopf.TemporaryError("Waiting for topic to be finished creating by backend.", delay=10 if retry < 5 else 20 if retry < 10 else 30)
+        wait_for("Waiting for topic to be finished creating by backend.")
     return backend, backend_name, status["broker_name"], status["topic_name"], topic_object["spec"].get("allowedK8sNamespaces", [])
@@ -1,9 +1,15 @@
 import asyncio
 import logging
-import random
+import time
 import kopf
+from hybridcloud_core.configuration import config_get
+_handler_import_start = time.perf_counter()
 # Import the handlers so kopf sees them
-from .handlers import broker, topic, topic_subscription, queue, queue_consumer
+from .handlers import broker, topic, topic_subscription, queue, queue_consumer, secrets, throughput_probe, metrics as metrics_handlers
+from .handlers.routing import preload_backends, configured_backends
+from .util import retry, circuit_breaker, profiling, metrics, executors
+from .util.k8s import API_GROUP, watched_namespaces
+_handler_import_duration = time.perf_counter() - _handler_import_start
 
 
 logger = logging.getLogger('azure')
@@ -15,14 +21,31 @@ logger = logging.getLogger('aiohttp.access')
 logger.setLevel(logging.WARNING)
 
 
+# Signal handlers can only be installed from the main thread, startup handlers run in the executor
+profiling.install_signal_handler(logging.getLogger("hybridcloud.profiling"))
+
+
+class OwnAnnotationsDiffBaseStorage(kopf.AnnotationsDiffBaseStorage):
+    """Leaves annotations of other tools out of the last handled configuration stored on every object.
+       They are never read by the handlers, so changes to them also no longer trigger the update handlers"""
+    def build(self, *, body, extra_fields=None):
+        essence = super().build(body=body, extra_fields=extra_fields)
+        annotations = essence.get("metadata", dict()).get("annotations")
+        if annotations:
+            essence["metadata"]["annotations"] = {k: v for k, v in annotations.items() if k.startswith(f"{API_GROUP}/")}
+        return essence
+
+
 class InfiniteBackoffsWithJitter:
     def __iter__(self):
+        delay = None
         while True:
-            yield 10 + random.randint(-5, +5)
+            delay = retry.next_delay("kubernetes", delay)
+            yield delay
 
 
 @kopf.on.startup()
-def configure(settings: kopf.OperatorSettings, **_):
+def configure(settings: kopf.OperatorSettings, logger, **_):
     # We don't want normal log messages in the events of the objects
     settings.posting.level = logging.CRITICAL
     # Infinite Backoffs so the operator never stops working in case of kubernetes errors
@@ -32,8 +55,36 @@ def configure(settings: kopf.OperatorSettings, **_):
     settings.watching.connect_timeout = 60
     settings.watching.client_timeout = 120
     settings.networking.request_timeout = 120
+    if executors.enabled():
+        # The dispatched handlers are async and do not use the kopf executor, its size is left as it is
+        executors.setup(configured_backends())
+    if config_get("watch.ignore_foreign_annotations", default=False):
+        settings.persistence.diffbase_storage = OwnAnnotationsDiffBaseStorage()
+    if metrics.enabled():
+        metrics.start_server()
+    _report_startup(logger)
+
+
+@kopf.on.probe(id="circuit_breakers")
+def circuit_breaker_states(**_):
+    # Included in the liveness endpoint so the state of the breakers can be scraped
+    return circuit_breaker.states()
+
+
+@kopf.on.probe(id="executors")
+def executor_occupancy(**_):
+    return executors.states()
+
+
+def _report_startup(logger):
+    report = preload_backends(logger)
+    parts = [f"handlers import={_handler_import_duration:.3f}s"]
+    for backend_name, timings in report.items():
+        parts.append(f"{backend_name} import={timings['import']:.3f}s init={timings['init']:.3f}s")
+    logger.info("Startup timings: " + ", ".join(parts))
 
 
 def run():
     """Used to run the operator when not run via kopf cli"""
-    asyncio.run(kopf.operator())
+    namespaces = watched_namespaces()
+    asyncio.run(kopf.operator(clusterwide=not namespaces, namespaces=namespaces))
@@ -0,0 +1,95 @@
+import argparse
+import json
+import logging
+import sys
+import kubernetes
+from hybridcloud_core.configuration import config_get
+from .handlers.routing import amqp_backend
+from .util import k8s
+
+
+def _key(obj):
+    return (obj["metadata"]["namespace"], obj["metadata"]["name"])
+
+
+def _ref(obj, ref_field):
+    ref = obj["spec"][ref_field]
+    return (ref.get("namespace", obj["metadata"]["namespace"]), ref["name"])
+
+
+def _broker_ref(obj):
+    return k8s.broker_ref(obj["metadata"]["namespace"], obj["spec"], obj.get("status"))
+
+
+def _entry(kind, obj, broker, parent=None):
+    return {"kind": kind, "namespace": obj["metadata"]["namespace"], "name": obj["metadata"]["name"], "spec": obj.get("spec", dict()), "status": obj.get("status") or dict(), "broker": broker, "parent": parent}
+
+
+def collect_entries():
+    """Lists all custom objects once and groups them by the backend of their broker"""
+    default_backend = config_get("backend", fail_if_missing=True)
+    brokers = {_key(obj): obj for obj in k8s.list_custom_objects(k8s.AMQPBroker)}
+    topics = {_key(obj): obj for obj in k8s.list_custom_objects(k8s.AMQPTopic)}
+    queues = {_key(obj): obj for obj in k8s.list_custom_objects(k8s.AMQPQueue)}
+
+    def _backend_name(broker_key):
+        broker = brokers[broker_key]
+        return (broker.get("status") or dict()).get("backend", broker.get("spec", dict()).get("backend", default_backend))
+
+    entries = dict()
+    def _add(backend_name, entry):
+        entries.setdefault(backend_name, []).append(entry)
+
+    for broker_key, obj in brokers.items():
+        _add(_backend_name(broker_key), _entry("AMQPBroker", obj, broker_key))
+    for kind, objects in [("AMQPTopic", topics), ("AMQPQueue", queues)]:
+        for obj in objects.values():
+            broker_key = _broker_ref(obj)
+            if broker_key in brokers:
+                _add(_backend_name(broker_key), _entry(kind, obj, broker_key))
+    for kind, child_type, parents, ref_field in [("AMQPTopicSubscription", k8s.AMQPTopicSubscription, topics, "topicRef"), ("AMQPQueueConsumer", k8s.AMQPQueueConsumer, queues, "queueRef")]:
+        for obj in k8s.list_custom_objects(child_type):
+            parent_key = _ref(obj, ref_field)
+            if parent_key not in parents:
+                continue
+            broker_key = _broker_ref(parents[parent_key])
+            if broker_key in brokers:
+                _add(_backend_name(broker_key), _entry(kind, obj, broker_key, parent_key))
+    return entries
+
+
+def compute_plan(logger):
+    results = []
+    for backend_name, entries in collect_entries().items():
+        backend = amqp_backend(backend_name, logger)
+        for result in backend.plan(entries):
+            result["backend"] = backend_name
+            results.append(result)
+    return results
+
+
+def run(argv=None):
+    """Prints the actions the operator would take for all objects with the current configuration without changing anything"""
+    parser = argparse.ArgumentParser(description="Show what the operator would change with the current configuration")
+    parser.add_argument("--json", action="store_true", help="Print the plan as json")
+    parser.add_argument("--all", action="store_true", help="Also show objects that would not be changed")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        kubernetes.config.load_incluster_config()
+    except kubernetes.config.ConfigException:
+        kubernetes.config.load_kube_config()
+    results = compute_plan(logging.getLogger("plan"))
+    if not args.all:
+        results = [result for result in results if result["action"] != "noop"]
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    for result in results:
+        changes = f" ({', '.join(result['changes'])})" if result["changes"] else ""
+        print(f"{result['action']:<7} {result['kind']:<22} {result['namespace']}/{result['name']} -> {result['backend']}:{result['entity']}{changes}")
+    summary = dict()
+    for result in results:
+        summary[result["action"]] = summary.get(result["action"], 0) + 1
+    print(", ".join(f"{count} to {action}" for action, count in sorted(summary.items())) or "Nothing to do")
@@ -0,0 +1,36 @@
+import argparse
+import json
+import sys
+from .util.throughput import run_probe, ProbeError
+
+
+def run(argv=None):
+    """Runs a throughput probe against a rabbitmq without kubernetes or the operator, e.g. one started locally with `docker run -p 5672:5672 rabbitmq`"""
+    parser = argparse.ArgumentParser(description="Measure the throughput of a queue of a local rabbitmq")
+    parser.add_argument("--hostname", default="localhost", help="Hostname of the rabbitmq")
+    parser.add_argument("--port", type=int, default=5672, help="AMQP port of the rabbitmq")
+    parser.add_argument("--user", default="guest", help="User to log in with")
+    parser.add_argument("--password", default="guest", help="Password of the user")
+    parser.add_argument("--queue", default="throughput-probe", help="Queue to use, a temporary queue with this name is created unless --existing is set")
+    parser.add_argument("--existing", action="store_true", help="Use an existing queue instead of a temporary one, it must be empty")
+    parser.add_argument("--messages", type=int, default=1000, help="Number of messages to send")
+    parser.add_argument("--size", type=int, default=1024, help="Size of each message in bytes")
+    parser.add_argument("--timeout", type=float, default=60, help="Maximum duration of the probe in seconds")
+    args = parser.parse_args(argv)
+    # Same fields as in the credentials secret of an AMQPQueue of the rabbitmq backend
+    credentials = {
+        "auth_method": "user-password",
+        "hostname": args.hostname,
+        "port": str(args.port),
+        "protocol": "amqp",
+        "user": args.user,
+        "password": args.password,
+        "entity": f"/queue/{args.queue}",
+    }
+    try:
+        result = run_probe(credentials, True, args.messages, args.size, args.timeout, temporary=not args.existing)
+    except ProbeError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    json.dump(result, sys.stdout, indent=2)
+    print()
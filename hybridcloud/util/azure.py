@@ -1,15 +1,92 @@
+import time
+from urllib.parse import urlparse
+from azure.core.credentials import AccessToken
+from azure.core.pipeline.policies import HTTPPolicy, SansIOHTTPPolicy
+from azure.core.pipeline.transport import RequestsTransport
 from azure.identity import DefaultAzureCredential
+from azure.mgmt.resource import ResourceManagementClient
 from azure.mgmt.servicebus.v2021_06_01_preview import ServiceBusManagementClient
 from hybridcloud_core.configuration import get_one_of
+from . import circuit_breaker, instrumentation, recording
 
 
 def _subscription_id():
     return get_one_of("backends.azureservicebus.subscription_id", "backends.azure.subscription_id", fail_if_missing=True)
 
 
+class StaticCredential:
+    """Used while replaying a recording or talking to a local fake of ARM so no real credentials are needed"""
+    def get_token(self, *scopes, **kwargs):
+        return AccessToken("replay", int(time.time()) + 3600)
+
+
 def _credentials():
+    if recording.mode() == recording.REPLAY:
+        return StaticCredential()
     return DefaultAzureCredential()
 
 
+class CircuitBreakerPolicy(HTTPPolicy):
+    """Fails fast while ARM is unhealthy for the subscription. Runs once per call, so retries of the sdk count as one failure"""
+    def __init__(self, key):
+        super().__init__()
+        self._breaker = circuit_breaker.circuit_breaker(key)
+
+    def send(self, request):
+        self._breaker.before_call()
+        try:
+            response = self.next.send(request)
+        except Exception:
+            self._breaker.record_failure()
+            raise
+        status_code = response.http_response.status_code
+        if status_code == 429 or status_code >= 500:
+            self._breaker.record_failure()
+        else:
+            self._breaker.record_success()
+        return response
+
+
+class TimingPolicy(HTTPPolicy):
+    """Records the timing of every single http request to ARM, including retries done by the sdk"""
+    def send(self, request):
+        http_request = request.http_request
+        start = time.perf_counter()
+        outcome = "ok"
+        try:
+            response = self.next.send(request)
+            status_code = response.http_response.status_code
+            # A 404 on a read is the normal answer of the exists checks and not a failed call
+            if status_code >= 400 and not (status_code == 404 and http_request.method in ("GET", "HEAD")):
+                outcome = str(status_code)
+            return response
+        except Exception as e:
+            outcome = e.__class__.__name__
+            raise
+        finally:
+            instrumentation.record("http", "azureservicebus", http_request.method, time.perf_counter() - start, outcome, url=urlparse(http_request.url).path)
+
+
+def _client_options():
+    options = dict(per_retry_policies=[TimingPolicy()])
+    if circuit_breaker.enabled():
+        options["per_call_policies"] = [CircuitBreakerPolicy(f"arm:{_subscription_id()}")]
+    if recording.mode() != recording.OFF:
+        options["transport"] = RequestsTransport(session=recording.session("azureservicebus"), session_owner=False)
+    return options
+
+
 def servicebus_client() -> ServiceBusManagementClient:
-    return ServiceBusManagementClient(_credentials(), _subscription_id())
+    return ServiceBusManagementClient(_credentials(), _subscription_id(), **_client_options())
+
+
+def resource_client() -> ResourceManagementClient:
+    # The endpoint can be overwritten to test against a local fake of the ARM deployments API, which does not need real credentials
+    endpoint = get_one_of("backends.azureservicebus.arm_deployment.endpoint", "backends.azure.arm_deployment.endpoint", default=None)
+    if endpoint:
+        options = _client_options()
+        if urlparse(endpoint).scheme == "http":
+            # The bearer token policy of azure-core refuses to send tokens over plain http, the fake does not check them anyway
+            options["authentication_policy"] = SansIOHTTPPolicy()
+        return ResourceManagementClient(StaticCredential(), _subscription_id(), base_url=endpoint, **options)
+    return ResourceManagementClient(_credentials(), _subscription_id(), **_client_options())
@@ -0,0 +1,97 @@
+import threading
+import time
+import kopf
+from hybridcloud_core.configuration import config_get
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(kopf.TemporaryError):
+    def __init__(self, key, delay):
+        super().__init__(f"Circuit breaker for {key} is open, not calling it for {int(delay)}s", delay=delay)
+        self.key = key
+
+
+class CircuitBreaker:
+    def __init__(self, key, failure_threshold, reset_timeout):
+        self.key = key
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return CLOSED
+        if time.monotonic() - self._opened_at < self._reset_timeout:
+            return OPEN
+        return HALF_OPEN
+
+    def before_call(self):
+        """Raises CircuitOpenError if calls are currently not allowed. In half-open state a single trial call is let through"""
+        with self._lock:
+            state = self._state()
+            if state == OPEN:
+                raise CircuitOpenError(self.key, self._reset_timeout - (time.monotonic() - self._opened_at))
+            if state == HALF_OPEN:
+                if self._trial_running:
+                    raise CircuitOpenError(self.key, self._reset_timeout)
+                self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self._failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+    def call(self, func):
+        self.before_call()
+        try:
+            result = func()
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+_breakers = dict()
+_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(key):
+    with _breakers_lock:
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker(
+                key,
+                int(config_get("circuit_breaker.failure_threshold", default=5)),
+                float(config_get("circuit_breaker.reset_timeout_seconds", default=60)),
+            )
+        return _breakers[key]
+
+
+def enabled():
+    return config_get("circuit_breaker.enabled", default=True)
+
+
+def states():
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.key: breaker.state for breaker in breakers}
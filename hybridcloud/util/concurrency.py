@@ -0,0 +1,35 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from hybridcloud_core.configuration import config_get
+from . import profiling
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_local = threading.local()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if not _executor:
+            _executor = ThreadPoolExecutor(max_workers=int(config_get("parallel_calls.max_workers", default=20)), thread_name_prefix="parallel-calls")
+    return _executor
+
+
+def _run_marked(func):
+    _local.in_pool = True
+    try:
+        return func()
+    finally:
+        _local.in_pool = False
+
+
+def run_parallel(*funcs):
+    """Runs independent calls concurrently and returns their results in the order the calls were given.
+       Calls made from inside the pool are run sequentially to avoid exhausting it with nested fan-outs,
+       as are calls of a handler that is being profiled so the profile covers them."""
+    if len(funcs) < 2 or getattr(_local, "in_pool", False) or profiling.active() or not config_get("parallel_calls.enabled", default=True):
+        return [func() for func in funcs]
+    futures = [_get_executor().submit(_run_marked, func) for func in funcs]
+    return [future.result() for future in futures]
@@ -1,2 +1,2 @@
-BACKOFF = None # Change to something small (e.g. 5) during development to get faster retries in case of exceptions in the handlers
+BACKOFF = None # Only applies to errors not handled by util.retry.retry_policy, change to something small (e.g. 5) during development to get faster retries
 HELM_BASE_PATH = "./charts"
@@ -0,0 +1,135 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import kopf
+from hybridcloud_core.configuration import config_get, get_one_of
+from . import metrics
+
+
+# Operation classes with their default number of workers and queued calls, can be overwritten via executors.<class>.max_workers/queue_size
+# and per backend via executors.<backend>.<class>.max_workers/queue_size
+PROVISIONING = "provisioning"
+ENTITIES = "entities"
+CREDENTIALS = "credentials"
+_DEFAULTS = {
+    PROVISIONING: (2, 20),
+    ENTITIES: (8, 100),
+    CREDENTIALS: (4, 100),
+}
+
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+class BoundedPool:
+    def __init__(self, backend_name, operation_class, max_workers, queue_size):
+        self.backend_name = backend_name
+        self.operation_class = operation_class
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{backend_name}-{operation_class}")
+        self._slots = threading.BoundedSemaphore(max_workers + queue_size)
+        self._lock = threading.Lock()
+        self._active = 0
+        self._pending = 0
+
+    async def run(self, func, *args, **kwargs):
+        """Runs the call in the pool, the event loop of kopf awaits it without blocking a thread. If all workers are busy and the queue is full the handler is retried later"""
+        if not self._slots.acquire(blocking=False):
+            raise kopf.TemporaryError(f"Executor {self.backend_name}/{self.operation_class} is full", delay=float(config_get("executors.retry_delay_seconds", default=10)))
+        self._update(pending=1)
+        try:
+            # run_in_executor does not pass on the context, kopf keeps e.g. the logging context of the handler there
+            context = contextvars.copy_context()
+            return await asyncio.get_running_loop().run_in_executor(self._executor, context.run, self._call, func, args, kwargs)
+        finally:
+            self._update(pending=-1)
+            self._slots.release()
+
+    def _call(self, func, args, kwargs):
+        self._update(active=1)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._update(active=-1)
+
+    def _update(self, active=0, pending=0):
+        with self._lock:
+            self._active += active
+            self._pending += pending
+            occupancy = self._occupancy()
+        metrics.publish_executor(self.backend_name, self.operation_class, occupancy)
+
+    def _occupancy(self):
+        return {"workers": self.max_workers, "active": self._active, "queued": self._pending - self._active}
+
+    def occupancy(self):
+        with self._lock:
+            return self._occupancy()
+
+
+def enabled():
+    return config_get("executors.enabled", default=False)
+
+
+def _limits(backend_name, operation_class):
+    max_workers, queue_size = _DEFAULTS[operation_class]
+    return (
+        int(get_one_of(f"executors.{backend_name}.{operation_class}.max_workers", f"executors.{operation_class}.max_workers", default=max_workers)),
+        int(get_one_of(f"executors.{backend_name}.{operation_class}.queue_size", f"executors.{operation_class}.queue_size", default=queue_size)),
+    )
+
+
+def _pool(backend_name, operation_class):
+    with _pools_lock:
+        if (backend_name, operation_class) not in _pools:
+            _pools[(backend_name, operation_class)] = BoundedPool(backend_name, operation_class, *_limits(backend_name, operation_class))
+        return _pools[(backend_name, operation_class)]
+
+
+def setup(backend_names):
+    """Creates the pools for all backends so their occupancy is reported from the start"""
+    for backend_name in backend_names:
+        for operation_class in _DEFAULTS.keys():
+            _pool(backend_name, operation_class)
+
+
+def states():
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {f"{pool.backend_name}/{pool.operation_class}": pool.occupancy() for pool in pools}
+
+
+def _backend_name(kwargs):
+    status = kwargs.get("status") or dict()
+    spec = kwargs.get("spec") or dict()
+    return status.get("backend") or spec.get("backend") or config_get("backend", fail_if_missing=True)
+
+
+def dispatched(operation_class):
+    """Turns the handler into an async handler that runs the sync handler in the pool of its backend and operation class,
+       so it does not use a thread of the kopf executor at all. Without dedicated executors the handler is left as it is"""
+    def decorator(func):
+        if not enabled():
+            return func
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await _pool(_backend_name(kwargs), operation_class).run(func, *args, **kwargs)
+        wrapper.undispatched = func
+        return wrapper
+    return decorator
+
+
+async def run_dispatched(operation_class, func, *args, **kwargs):
+    """Runs a sync handler called with keyword arguments from an async handler, in the pool of its backend and operation class or without dedicated executors in the default executor like kopf does"""
+    if enabled():
+        return await _pool(_backend_name(kwargs), operation_class).run(func, *args, **kwargs)
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+
+def undispatched(handler):
+    """Returns the sync handler behind a dispatched one, e.g. for a resume handler that already runs in a pool and calls the manage handler"""
+    return getattr(handler, "undispatched", handler)
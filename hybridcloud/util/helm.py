@@ -1,9 +1,59 @@
+import asyncio
+import hashlib
 import json
+import os
+import shlex
 import subprocess
+import threading
+import time
+from hybridcloud_core.configuration import config_get
+from . import instrumentation
 
 
-def run(cmd, fail=False, **kwargs):
-    res = subprocess.run(cmd, shell=True, capture_output=True, **kwargs)
+# All helm processes are driven by one event loop in its own thread, the handler threads only wait for their result
+_loop = None
+_loop_lock = threading.Lock()
+# Only used from the thread of the event loop
+_semaphore = None
+_charts = dict()
+_charts_lock = threading.Lock()
+# Digest of chart, options and values of the last successful install per release
+_installed = dict()
+_installed_lock = threading.Lock()
+
+
+def _event_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="helm", daemon=True).start()
+        return _loop
+
+
+async def _run(args, input, timeout):
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(int(config_get("helm.max_concurrent", default=10)))
+    async with _semaphore:
+        process = await asyncio.create_subprocess_exec(*args, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(input), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise subprocess.TimeoutExpired(args, timeout)
+    return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+
+def run(cmd, fail=False, input=None, text=False, timeout=None):
+    """Runs the command as a subprocess without a shell. Waiting for a free slot (helm.max_concurrent) does not count towards the timeout"""
+    timeout = float(timeout or config_get("helm.timeout_seconds", default=300))
+    if text and input is not None:
+        input = input.encode("utf-8")
+    res = asyncio.run_coroutine_threadsafe(_run(shlex.split(cmd), input, timeout), _event_loop()).result()
+    if text:
+        res.stdout, res.stderr = res.stdout.decode("utf-8"), res.stderr.decode("utf-8")
     if fail:
         if res.returncode != 0:
             print(res.stdout)
@@ -13,14 +63,49 @@ def run(cmd, fail=False, **kwargs):
 
 
 def run_helm(cmd, **kwargs):
-    return run(f"helm " + cmd, **kwargs)
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        res = run(f"helm " + cmd, **kwargs)
+        if res.returncode != 0:
+            outcome = f"exit-{res.returncode}"
+        return res
+    except Exception as e:
+        outcome = e.__class__.__name__
+        raise
+    finally:
+        instrumentation.record("helm", "rabbitmq", cmd.split(" ")[0], time.perf_counter() - start, outcome)
+
+
+def _packaged_chart(chart):
+    """Packages a chart directory once so installs load a single archive instead of reading and parsing the chart directory every time"""
+    if not os.path.isdir(chart):
+        return chart
+    with _charts_lock:
+        if chart not in _charts:
+            cache_dir = config_get("helm.chart_cache_dir", default="/tmp/helm-charts")
+            os.makedirs(cache_dir, exist_ok=True)
+            res = run_helm(f"package {chart} -d {cache_dir}", fail=True, text=True)
+            # helm prints "Successfully packaged chart and saved it to: <path>"
+            _charts[chart] = res.stdout.strip().split(" ")[-1]
+        return _charts[chart]
 
 
 def install_upgrade(namespace, name, chart, options, values=None):
+    """Installs or upgrades the release. Returns None without calling helm if the release was already installed with the same chart, options and values"""
+    chart = _packaged_chart(chart)
+    digest = hashlib.sha256(f"{chart}\n{options}\n{values}".encode("utf-8")).hexdigest()
+    with _installed_lock:
+        unchanged = _installed.get((namespace, name)) == digest
+    if unchanged and check_installed(namespace, name):
+        return None
     if values:
-        return run_helm(f"upgrade --install -n {namespace} {name} {chart} -f - {options}", fail=True, input=values, text=True)
+        res = run_helm(f"upgrade --install -n {namespace} {name} {chart} -f - {options}", fail=True, input=values, text=True)
     else:
-        return run_helm(f"upgrade --install -n {namespace} {name} {chart} {options}", fail=True)
+        res = run_helm(f"upgrade --install -n {namespace} {name} {chart} {options}", fail=True)
+    with _installed_lock:
+        _installed[(namespace, name)] = digest
+    return res
 
 
 def check_installed(namespace, name):
@@ -34,5 +119,12 @@ def check_installed(namespace, name):
     return False
 
 
+def list_all():
+    res = run_helm("list -A -o json", fail=True)
+    return json.loads(res.stdout)
+
+
 def uninstall(namespace, name):
+    with _installed_lock:
+        _installed.pop((namespace, name), None)
     return run_helm(f"uninstall -n {namespace} {name}", fail=True)
@@ -0,0 +1,77 @@
+import functools
+import inspect
+import json
+import logging
+import random
+import time
+from hybridcloud_core.configuration import config_get
+from .retry import current_attempt
+
+
+_logger = logging.getLogger("hybridcloud.timing")
+_BROKER_ARGUMENTS = ["broker_name", "namespace_name"]
+_ENTITY_ARGUMENTS = ["subscription_name", "topic_name", "queue_name"]
+
+
+def _config():
+    return (
+        config_get("instrumentation.enabled", default=True),
+        float(config_get("instrumentation.sample_rate", default=0.0)),
+        float(config_get("instrumentation.slow_call_threshold_seconds", default=5)),
+    )
+
+
+def record(layer, backend, method, duration, outcome, **fields):
+    """Emits one timing record as json. Slow and failed calls are always logged, all others only for the configured sample rate"""
+    enabled, sample_rate, slow_threshold = _config()
+    if not enabled:
+        return
+    slow = duration >= slow_threshold
+    if outcome == "ok" and not slow and random.random() >= sample_rate:
+        return
+    data = {"layer": layer, "backend": backend, "method": method, "duration": round(duration, 4), "outcome": outcome, "slow": slow, "attempt": current_attempt()}
+    data.update({k: v for k, v in fields.items() if v is not None})
+    _logger.log(logging.WARNING if slow or outcome != "ok" else logging.INFO, json.dumps(data))
+
+
+def timed(layer, backend, method, func, **fields):
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        return func()
+    except Exception as e:
+        outcome = e.__class__.__name__
+        raise
+    finally:
+        record(layer, backend, method, time.perf_counter() - start, outcome, **fields)
+
+
+def _call_fields(signature, args, kwargs):
+    arguments = signature.bind_partial(*args, **kwargs).arguments
+    broker = next((arguments[arg] for arg in _BROKER_ARGUMENTS if arguments.get(arg)), None)
+    if arguments.get("namespace") and arguments.get("name"):
+        entity = f"{arguments['namespace']}/{arguments['name']}"
+    else:
+        entity = next((arguments[arg] for arg in _ENTITY_ARGUMENTS if arguments.get(arg)), None)
+    return broker, entity
+
+
+def instrumented(backend_name):
+    """Class decorator that records the timing of every public method of a backend"""
+    def decorator(cls):
+        for attr_name, attr in list(vars(cls).items()):
+            if attr_name.startswith("_") or not inspect.isfunction(attr):
+                continue
+            setattr(cls, attr_name, _instrument_method(backend_name, attr))
+        return cls
+    return decorator
+
+
+def _instrument_method(backend_name, method):
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        broker, entity = _call_fields(signature, args, kwargs)
+        return timed("backend", backend_name, method.__name__, lambda: method(*args, **kwargs), broker=broker, entity=entity)
+    return wrapper
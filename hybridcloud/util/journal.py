@@ -0,0 +1,41 @@
+from hybridcloud_core.configuration import config_get
+from hybridcloud_core.k8s.api import patch_namespaced_custom_object_status
+from .k8s import spec_hash
+
+
+class Journal:
+    """Records completed reconcile steps in the status of the object so a reconcile interrupted by a restart can resume
+       after the last completed step instead of repeating it. Only valid for the spec it was written for."""
+
+    def __init__(self, resource, namespace, name, spec, status):
+        self._resource = resource
+        self._namespace = namespace
+        self._name = name
+        self._spec_hash = spec_hash(spec)
+        self._enabled = config_get("journal.enabled", default=True)
+        stored = (status or dict()).get("journal") or dict()
+        if self._enabled and stored.get("specHash") == self._spec_hash:
+            self._steps = dict(stored.get("steps", dict()))
+        else:
+            self._steps = dict()
+
+    def done(self, step):
+        return step in self._steps
+
+    def record(self, step, value=True):
+        self._steps[step] = value
+        if self._enabled:
+            patch_namespaced_custom_object_status(self._resource, self._namespace, self._name, {"journal": {"specHash": self._spec_hash, "steps": self._steps}})
+
+    def run(self, step, func):
+        """Runs the step unless it was already completed, returns the value recorded for the step"""
+        if step in self._steps:
+            return self._steps[step]
+        value = func()
+        self.record(step, value)
+        return value
+
+
+def clear_journal(status_obj):
+    # The journal is only needed while a reconcile is in progress
+    status_obj["journal"] = None
@@ -1,4 +1,9 @@
+import hashlib
+import json
+from fnmatch import fnmatch
+import kopf
 import kubernetes
+from hybridcloud_core.configuration import config_get
 from hybridcloud_core.k8s.resources import Resource, Scope
 
 
@@ -10,3 +15,83 @@ AMQPTopic = Resource(API_GROUP, "v1alpha1", "amqptopics", "AMQPTopic", Scope.NAM
 AMQPQueue = Resource(API_GROUP, "v1alpha1", "amqpqueues", "AMQPQueue", Scope.NAMESPACED)
 AMQPTopicSubscription = Resource(API_GROUP, "v1alpha1", "amqptopicsubscriptions", "AMQPTopicSubscription", Scope.NAMESPACED)
 AMQPQueueConsumer = Resource(API_GROUP, "v1alpha1", "amqpqueueconsumers", "AMQPQueueConsumer", Scope.NAMESPACED)
+AMQPBrokerPool = Resource(API_GROUP, "v1alpha1", "amqpbrokerpools", "AMQPBrokerPool", Scope.NAMESPACED)
+AMQPThroughputProbe = Resource(API_GROUP, "v1alpha1", "amqpthroughputprobes", "AMQPThroughputProbe", Scope.NAMESPACED)
+
+
+def watched_namespaces():
+    """Namespaces or glob patterns from watch.namespaces, patterns starting with ! exclude namespaces. Empty means all namespaces"""
+    namespaces = config_get("watch.namespaces", default=[]) or []
+    if isinstance(namespaces, str):
+        # The helm chart passes the list comma-separated via an environment variable
+        namespaces = [namespace.strip() for namespace in namespaces.split(",") if namespace.strip()]
+    return namespaces
+
+
+def namespace_in_scope(namespace):
+    patterns = watched_namespaces()
+    includes = [pattern for pattern in patterns if not pattern.startswith("!")]
+    excludes = [pattern[1:] for pattern in patterns if pattern.startswith("!")]
+    if includes and not any(fnmatch(namespace, pattern) for pattern in includes):
+        return False
+    return not any(fnmatch(namespace, pattern) for pattern in excludes)
+
+
+def listable_namespaces():
+    """Returns the watched namespaces if they can be listed one by one, None if the whole cluster has to be listed and filtered with namespace_in_scope"""
+    patterns = watched_namespaces()
+    if not patterns or any(char in pattern for pattern in patterns for char in "*?[!"):
+        return None
+    return patterns
+
+
+def list_custom_objects(resource):
+    group, version, plural = resource.kopf_on()
+    api = kubernetes.client.CustomObjectsApi()
+    namespaces = listable_namespaces()
+    if namespaces:
+        items = []
+        for namespace in namespaces:
+            items.extend(api.list_namespaced_custom_object(group, version, namespace, plural, label_selector=_label_selector()).get("items", []))
+        return items
+    items = api.list_cluster_custom_object(group, version, plural, label_selector=_label_selector()).get("items", [])
+    return [obj for obj in items if namespace_in_scope(obj["metadata"]["namespace"])]
+
+
+def marked_for_deletion(obj):
+    return bool(obj.get("metadata", dict()).get("deletionTimestamp"))
+
+
+def spec_hash(spec):
+    """Hash of the spec of an object. The CRDs have no status subresource so every status write bumps metadata.generation,
+       the generation can not be used to tell whether the spec changed"""
+    return hashlib.sha256(json.dumps(dict(spec or dict()), sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def credentials_issued(status):
+    """Whether a consumer or subscription already got credentials. status.credentials_rule then names the shared rule they were issued from,
+       if it is missing or None they were issued from the own rule of the object"""
+    status = status or dict()
+    return "credentials_rule" in status or (status.get("deployment") or dict()).get("status") == "finished"
+
+
+def broker_ref(namespace, spec, status):
+    """Returns (namespace, name) of the AMQPBroker of a topic or queue, either referenced directly or chosen from a pool and recorded in the status"""
+    ref = spec.get("brokerRef") or (status or dict()).get("broker_ref")
+    if not ref:
+        return None
+    return (ref.get("namespace", namespace), ref["name"])
+
+
+def watch_filters():
+    """Keyword arguments for the handlers of the custom objects so only objects matching the configured label selector are handled.
+       A label without a value only has to be present"""
+    labels = config_get("watch.labels", default=None)
+    if not labels:
+        return dict()
+    return dict(labels={key: kopf.PRESENT if value is None else value for key, value in labels.items()})
+
+
+def _label_selector():
+    labels = config_get("watch.labels", default=None) or dict()
+    return ",".join(key if value is None else f"{key}={value}" for key, value in labels.items()) or None
@@ -0,0 +1,50 @@
+import threading
+from hybridcloud_core.configuration import config_get
+from prometheus_client import Gauge, Histogram, start_http_server
+
+
+_LABELS = ["kind", "namespace", "name", "broker", "entity"]
+_active_messages = Gauge("hybridcloud_amqp_active_messages", "Number of messages waiting to be consumed", _LABELS)
+_dead_letter_messages = Gauge("hybridcloud_amqp_dead_letter_messages", "Number of messages in the dead letter queue", _LABELS)
+_executor_workers = Gauge("hybridcloud_executor_workers", "Number of worker threads of the executor", ["backend", "operation_class"])
+_executor_active = Gauge("hybridcloud_executor_active", "Number of handler calls currently running in the executor", ["backend", "operation_class"])
+_executor_queued = Gauge("hybridcloud_executor_queued", "Number of handler calls waiting for a worker of the executor", ["backend", "operation_class"])
+_time_to_ready = Histogram("hybridcloud_time_to_ready_seconds", "Time from creation of an object until it was finished for the first time", ["kind"],
+                           buckets=(5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600))
+# Label values published per broker so gauges of removed objects can be dropped
+_published = dict()
+_lock = threading.Lock()
+
+
+def enabled():
+    return config_get("metrics.enabled", default=False)
+
+
+def start_server():
+    start_http_server(int(config_get("metrics.port", default=9090)))
+
+
+def publish(broker_key, samples):
+    """Replaces the gauges of all queues and subscriptions of a broker with the given samples (list of (labels, counts))"""
+    with _lock:
+        previous = _published.get(broker_key, set())
+        current = set()
+        for labels, counts in samples:
+            label_values = tuple(labels[label] for label in _LABELS)
+            _active_messages.labels(*label_values).set(counts["active"])
+            _dead_letter_messages.labels(*label_values).set(counts["deadLetter"])
+            current.add(label_values)
+        for label_values in previous - current:
+            _active_messages.remove(*label_values)
+            _dead_letter_messages.remove(*label_values)
+        _published[broker_key] = current
+
+
+def publish_executor(backend_name, operation_class, occupancy):
+    _executor_workers.labels(backend_name, operation_class).set(occupancy["workers"])
+    _executor_active.labels(backend_name, operation_class).set(occupancy["active"])
+    _executor_queued.labels(backend_name, operation_class).set(occupancy["queued"])
+
+
+def observe_time_to_ready(kind, seconds):
+    _time_to_ready.labels(kind).observe(seconds)
@@ -0,0 +1,74 @@
+import cProfile
+import functools
+import inspect
+import os
+import signal
+import threading
+import time
+from datetime import datetime, timezone
+from hybridcloud_core.configuration import config_get
+from .k8s import API_GROUP
+
+
+PROFILE_ANNOTATION = f"{API_GROUP}/profile"
+
+
+_window_end = 0.0
+_local = threading.local()
+
+
+def active():
+    """Returns True if the handler running in the current thread is being profiled"""
+    return getattr(_local, "active", False)
+
+
+def start_window(seconds=None):
+    """Profiles all handler calls of the process for the given time"""
+    global _window_end
+    _window_end = time.monotonic() + float(seconds or config_get("profiling.window_seconds", default=60))
+
+
+def install_signal_handler(logger):
+    # Only reachable via kubectl exec so there is no need for an extra endpoint
+    def _handler(signum, frame):
+        start_window()
+        logger.info("Profiling all handlers for the next window")
+    signal.signal(signal.SIGUSR1, _handler)
+
+
+def _requested_token(meta, status):
+    token = (meta.get("annotations") or dict()).get(PROFILE_ANNOTATION)
+    if token and token != ((status or dict()).get("profile") or dict()).get("token"):
+        return token
+    return None
+
+
+def _dump(profiler, func_name, namespace, name):
+    output_dir = config_get("profiling.output_dir", default="/tmp/profiles")
+    os.makedirs(output_dir, exist_ok=True)
+    filename = os.path.join(output_dir, f"{func_name}-{namespace}-{name}-{datetime.now(tz=timezone.utc).strftime('%Y%m%dT%H%M%S%f')}.prof")
+    profiler.dump_stats(filename)
+    return filename
+
+
+def profiled(func):
+    """Runs the handler under cProfile if the object carries a new value in the profile annotation or a profiling window is active.
+       When neither is the case the handler is called directly."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        arguments = inspect.signature(func).bind_partial(*args, **kwargs).arguments
+        meta = arguments.get("meta", kwargs.get("meta")) or dict()
+        token = _requested_token(meta, arguments.get("status", kwargs.get("status")))
+        if not token and time.monotonic() >= _window_end:
+            return func(*args, **kwargs)
+        profiler = cProfile.Profile()
+        _local.active = True
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            _local.active = False
+            filename = _dump(profiler, func.__name__, arguments.get("namespace"), arguments.get("name"))
+            patch = arguments.get("patch", kwargs.get("patch"))
+            if token and patch is not None:
+                patch.setdefault("status", dict())["profile"] = {"token": token, "file": filename}
+    return wrapper
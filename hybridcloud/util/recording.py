@@ -0,0 +1,136 @@
+import collections
+import json
+import threading
+import time
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from hybridcloud_core.configuration import config_get
+
+
+OFF = "off"
+RECORD = "record"
+REPLAY = "replay"
+# Fields whose values are replaced before a body is written to the recording
+_SECRET_FIELDS = ["primaryKey", "secondaryKey", "primaryConnectionString", "secondaryConnectionString", "aliasPrimaryConnectionString", "aliasSecondaryConnectionString", "password", "password_hash"]
+_RECORDED_HEADERS = ["Content-Type", "Retry-After", "Location", "Azure-AsyncOperation", "Azure-AsyncNotification"]
+
+
+_write_lock = threading.Lock()
+_recordings = dict()
+_recordings_lock = threading.Lock()
+
+
+def mode():
+    # An unquoted off in yaml is read as false
+    return config_get("recording.mode", default=OFF) or OFF
+
+
+def _file():
+    return config_get("recording.file", default="/tmp/recording.jsonl")
+
+
+def _sanitize(value):
+    if isinstance(value, dict):
+        return {k: "***" if k in _SECRET_FIELDS else _sanitize(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_sanitize(v) for v in value]
+    return value
+
+
+def _sanitize_body(body):
+    # Only json bodies are recorded as only they can be sanitized reliably
+    if not body:
+        return None
+    try:
+        return json.dumps(_sanitize(json.loads(body)))
+    except (ValueError, TypeError):
+        return None
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Sends requests as usual and appends the sanitized request/response pair with its duration to the recording file"""
+    def __init__(self, backend_name):
+        super().__init__()
+        self._backend_name = backend_name
+
+    def send(self, request, **kwargs):
+        start = time.perf_counter()
+        response = super().send(request, **kwargs)
+        entry = {
+            "backend": self._backend_name,
+            "method": request.method,
+            "url": request.url,
+            "request_body": _sanitize_body(request.body),
+            "status": response.status_code,
+            "headers": {header: response.headers[header] for header in _RECORDED_HEADERS if header in response.headers},
+            "body": _sanitize_body(response.content),
+            "duration": time.perf_counter() - start,
+        }
+        with _write_lock:
+            with open(_file(), "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        return response
+
+
+class Recording:
+    def __init__(self, filename):
+        self._lock = threading.Lock()
+        self._entries = collections.defaultdict(collections.deque)
+        with open(filename) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries[(entry["method"], entry["url"])].append(entry)
+
+    def next(self, method, url):
+        """Returns the recorded responses for a request in the recorded order, the last one is repeated once all were used"""
+        with self._lock:
+            entries = self._entries.get((method, url))
+            if not entries:
+                return None
+            if len(entries) > 1:
+                return entries.popleft()
+            return entries[0]
+
+
+def _recording(filename):
+    with _recordings_lock:
+        if filename not in _recordings:
+            _recordings[filename] = Recording(filename)
+        return _recordings[filename]
+
+
+class ReplayAdapter(BaseAdapter):
+    """Serves responses from the recording file instead of sending requests, waiting as long as the original call took"""
+    def send(self, request, **kwargs):
+        entry = _recording(_file()).next(request.method, request.url)
+        if not entry:
+            raise requests.exceptions.ConnectionError(f"No recorded response for {request.method} {request.url}", request=request)
+        time.sleep(entry["duration"] / float(config_get("recording.replay_speed", default=1.0)))
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response._content = (entry["body"] or "").encode("utf-8")
+        response.url = request.url
+        response.request = request
+        response.encoding = "utf-8"
+        return response
+
+    def close(self):
+        pass
+
+
+def session(backend_name):
+    """Returns a requests session that records or replays the http traffic of the backend depending on the configured mode"""
+    http_session = requests.Session()
+    current_mode = mode()
+    if current_mode == RECORD:
+        adapter = RecordingAdapter(backend_name)
+    elif current_mode == REPLAY:
+        adapter = ReplayAdapter()
+    else:
+        return http_session
+    http_session.mount("http://", adapter)
+    http_session.mount("https://", adapter)
+    return http_session
@@ -0,0 +1,155 @@
+import functools
+import inspect
+import random
+import subprocess
+import threading
+from datetime import datetime, timezone
+import kopf
+from hybridcloud_core.configuration import config_get
+from .circuit_breaker import CircuitOpenError
+
+
+# Failure classes with their default base and maximum delay in seconds, can be overwritten via retry.<class>.base and retry.<class>.cap
+THROTTLED = "throttled"
+SERVER = "server"
+DEPENDENCY = "dependency"
+CLIENT = "client"
+PERMANENT = "permanent"
+UNKNOWN = "unknown"
+_DEFAULTS = {
+    THROTTLED: (5, 120),
+    SERVER: (5, 300),
+    DEPENDENCY: (5, 30),
+    CLIENT: (30, 600),
+    UNKNOWN: (10, 300),
+    "kubernetes": (5, 30),
+}
+_PERMANENT_STATUS_CODES = [400, 405, 422]
+
+
+_previous_delays = dict()
+_lock = threading.Lock()
+# Key of the object the handler in the current thread is working on
+_local = threading.local()
+
+
+def _limits(retry_class):
+    base, cap = _DEFAULTS[retry_class]
+    return float(config_get(f"retry.{retry_class}.base", default=base)), float(config_get(f"retry.{retry_class}.cap", default=cap))
+
+
+def next_delay(retry_class, previous_delay=None):
+    """Decorrelated jitter: the next delay is random between the base and three times the previous delay, limited by the cap"""
+    base, cap = _limits(retry_class)
+    previous_delay = previous_delay or base
+    return min(cap, random.uniform(base, previous_delay * 3))
+
+
+def _status_code(exc):
+    status_code = getattr(exc, "status_code", None)
+    if status_code is None and getattr(exc, "response", None) is not None:
+        status_code = getattr(exc.response, "status_code", None)
+    if status_code is None and isinstance(getattr(exc, "status", None), int):
+        # kubernetes.client.ApiException
+        status_code = exc.status
+    return status_code
+
+
+def retry_after(exc):
+    response = getattr(exc, "response", None)
+    # kubernetes.client.ApiException has the headers directly
+    headers = getattr(response, "headers", None) or getattr(exc, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def classify(exc):
+    """Sorts an exception from the azure sdk, requests, the kubernetes client or helm into one of the failure classes"""
+    # Imported here so the classification does not force loading the libraries of unused backends
+    from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout
+    if isinstance(exc, (RequestsConnectionError, Timeout, ConnectionError, TimeoutError, subprocess.TimeoutExpired)):
+        return SERVER
+    if isinstance(exc, subprocess.CalledProcessError):
+        return UNKNOWN
+    status_code = _status_code(exc)
+    if status_code is None:
+        return UNKNOWN
+    if status_code == 429:
+        return THROTTLED
+    if status_code >= 500:
+        return SERVER
+    if status_code in _PERMANENT_STATUS_CODES:
+        return PERMANENT
+    if status_code >= 400:
+        return CLIENT
+    return UNKNOWN
+
+
+def delay_for(retry_class, key, minimum=None):
+    with _lock:
+        delay = next_delay(retry_class, _previous_delays.get((key, retry_class)))
+        if minimum:
+            delay = max(delay, minimum)
+        _previous_delays[(key, retry_class)] = delay
+    return delay
+
+
+def reset(key):
+    with _lock:
+        for stored_key in [k for k in _previous_delays.keys() if k[0] == key]:
+            del _previous_delays[stored_key]
+
+
+def current_attempt():
+    return getattr(_local, "attempt", None)
+
+
+def wait_for(message):
+    """Signals kopf to retry the handler because a dependency (e.g. the parent object) is not ready yet"""
+    raise kopf.TemporaryError(message, delay=delay_for(DEPENDENCY, getattr(_local, "key", None)))
+
+
+def retry_policy(func):
+    """Translates exceptions escaping a handler into kopf errors with a delay depending on the failure class"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        arguments = inspect.signature(func).bind_partial(*args, **kwargs).arguments
+        key = (func.__name__, arguments.get("namespace"), arguments.get("name"))
+        _local.key = key
+        _local.attempt = arguments.get("retry", kwargs.get("retry"))
+        patch = arguments.get("patch", kwargs.get("patch"))
+        status = arguments.get("status", kwargs.get("status")) or dict()
+        try:
+            result = func(*args, **kwargs)
+        except CircuitOpenError as e:
+            if patch is not None:
+                patch.setdefault("status", dict())["circuit_breaker"] = {"key": e.key, "state": "open"}
+            raise
+        except (kopf.TemporaryError, kopf.PermanentError):
+            raise
+        except Exception as e:
+            retry_class = classify(e)
+            if retry_class == PERMANENT and kwargs.get("reason") == kopf.Reason.DELETE:
+                # A permanent error would make kopf remove the finalizer and leak the entity, so deletions keep being retried
+                retry_class = CLIENT
+            if retry_class == PERMANENT:
+                # kopf stops retrying, so the object must not stay in working
+                if patch is not None:
+                    patch.setdefault("status", dict())["deployment"] = {
+                        "status": "failed",
+                        "reason": f"{e.__class__.__name__}: {e}",
+                        "latest-update": datetime.now(tz=timezone.utc).isoformat()
+                    }
+                raise kopf.PermanentError(f"{e.__class__.__name__}: {e}") from e
+            delay = delay_for(retry_class, key, retry_after(e))
+            raise kopf.TemporaryError(f"{retry_class} error: {e.__class__.__name__}: {e}", delay=delay) from e
+        reset(key)
+        if patch is not None and "circuit_breaker" in status:
+            patch.setdefault("status", dict())["circuit_breaker"] = None
+        return result
+    return wrapper
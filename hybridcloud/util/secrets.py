@@ -0,0 +1,122 @@
+import base64
+import hashlib
+import json
+import threading
+import time
+import kubernetes
+from hybridcloud_core.k8s.api import get_secret, delete_secret
+from .k8s import API_GROUP, namespace_in_scope
+
+
+MANAGED_LABEL = f"{API_GROUP}/managed-by"
+MANAGED_LABEL_VALUE = "hybrid-cloud-amqp-operator"
+HASH_ANNOTATION = f"{API_GROUP}/content-hash"
+_MANAGED_SELECTOR = f"{MANAGED_LABEL}={MANAGED_LABEL_VALUE}"
+
+
+# Content hashes of all operator-managed secrets, kept up-to-date by watch_managed_secrets
+_cache = dict()
+_cache_lock = threading.Lock()
+
+
+def content_hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def cache_update(namespace, name, annotations):
+    with _cache_lock:
+        _cache[(namespace, name)] = (annotations or dict()).get(HASH_ANNOTATION, "")
+
+
+def cache_remove(namespace, name):
+    with _cache_lock:
+        _cache.pop((namespace, name), None)
+
+
+def _replace_cache(namespace, secrets):
+    with _cache_lock:
+        for key in [key for key in _cache.keys() if namespace is None or key[0] == namespace]:
+            del _cache[key]
+        for secret in secrets:
+            if namespace_in_scope(secret.metadata.namespace):
+                _cache[(secret.metadata.namespace, secret.metadata.name)] = (secret.metadata.annotations or dict()).get(HASH_ANNOTATION, "")
+
+
+def watch_managed_secrets(logger, namespace=None):
+    """Keeps the cache up-to-date for one namespace or all namespaces in scope, runs forever.
+       The label selector is applied by the API server so only operator-managed secrets are sent to the operator"""
+    api = kubernetes.client.CoreV1Api()
+    if namespace:
+        list_func, args = api.list_namespaced_secret, [namespace]
+    else:
+        list_func, args = api.list_secret_for_all_namespaces, []
+    while True:
+        try:
+            secret_list = list_func(*args, label_selector=_MANAGED_SELECTOR)
+            _replace_cache(namespace, secret_list.items)
+            for event in kubernetes.watch.Watch().stream(list_func, *args, label_selector=_MANAGED_SELECTOR,
+                                                         resource_version=secret_list.metadata.resource_version, timeout_seconds=300):
+                secret = event["object"]
+                if not namespace_in_scope(secret.metadata.namespace):
+                    continue
+                if event["type"] == "DELETED":
+                    cache_remove(secret.metadata.namespace, secret.metadata.name)
+                else:
+                    cache_update(secret.metadata.namespace, secret.metadata.name, secret.metadata.annotations)
+        except Exception as e:
+            # E.g. an expired resource version, the cache is rebuilt from a new list
+            logger.warning(f"Watch of credential secrets failed, restarting it: {e}")
+            time.sleep(5)
+
+
+def _cached_hash(namespace, name):
+    with _cache_lock:
+        return _cache.get((namespace, name))
+
+
+def credentials_secret_exists(namespace, name):
+    """Answers from the watched cache for operator-managed secrets, falls back to the API for secrets not yet managed"""
+    if _cached_hash(namespace, name) is not None:
+        return True
+    return bool(get_secret(namespace, name))
+
+
+def write_credentials_secret(namespace, name, data):
+    """Creates or replaces the secret unless it already has exactly this content. Returns True if the secret was written"""
+    new_hash = content_hash(data)
+    if _cached_hash(namespace, name) == new_hash:
+        return False
+    labels = {MANAGED_LABEL: MANAGED_LABEL_VALUE}
+    annotations = {HASH_ANNOTATION: new_hash}
+    encoded_data = {k: base64.b64encode(str(v).encode("utf-8")).decode("utf-8") for k, v in data.items()}
+    body = kubernetes.client.V1Secret(
+        metadata=kubernetes.client.V1ObjectMeta(name=name, namespace=namespace, labels=labels, annotations=annotations),
+        type="Opaque",
+        data=encoded_data,
+    )
+    api = kubernetes.client.CoreV1Api()
+    try:
+        api.create_namespaced_secret(namespace, body)
+    except kubernetes.client.exceptions.ApiException as e:
+        if e.status != 409:
+            raise
+        # Only patch our own fields so labels, annotations and ownerReferences of other tools (e.g. Reloader, GitOps) are kept
+        api.patch_namespaced_secret(name, namespace, {"metadata": {"labels": labels, "annotations": annotations}, "data": encoded_data})
+    cache_update(namespace, name, annotations)
+    return True
+
+
+def delete_credentials_secret(namespace, name):
+    delete_secret(namespace, name)
+    cache_remove(namespace, name)
+
+
+def read_credentials_secret(namespace, name):
+    """Returns the decoded data of a credentials secret or None if it does not exist"""
+    try:
+        secret = kubernetes.client.CoreV1Api().read_namespaced_secret(name, namespace)
+    except kubernetes.client.exceptions.ApiException as e:
+        if e.status == 404:
+            return None
+        raise
+    return {k: base64.b64decode(v).decode("utf-8") for k, v in (secret.data or dict()).items()}
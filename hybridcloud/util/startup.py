@@ -0,0 +1,26 @@
+import asyncio
+import threading
+from hybridcloud_core.configuration import config_get
+
+
+_deferred_resumes = 0
+_lock = threading.Lock()
+
+
+def _next_resume_delay():
+    global _deferred_resumes
+    with _lock:
+        slot = _deferred_resumes
+        _deferred_resumes += 1
+    return float(config_get("startup.resume_delay_seconds", default=10)) + slot / float(config_get("startup.resumes_per_second", default=5))
+
+
+async def defer_resume(status, retry):
+    """Postpones the resume of an already finished object on startup so new and unfinished objects are handled first.
+       The resumes are spread out at a fixed rate instead of all being retried at the same time. The handler waits in the
+       event loop instead of being retried by kopf, so the deferral does not write any progress to the object"""
+    if retry or not config_get("startup.prioritize", default=True):
+        return
+    if ((status or dict()).get("deployment") or dict()).get("status") != "finished":
+        return
+    await asyncio.sleep(_next_resume_delay())
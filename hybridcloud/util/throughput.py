@@ -0,0 +1,236 @@
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from hybridcloud_core.configuration import config_get
+
+
+# Every probe message starts with the run id and the time it was sent, so the consumer can compute the latency and skip foreign messages
+_HEADER = struct.Struct("!16sd")
+
+
+def _message(run_id, size):
+    return _HEADER.pack(run_id, time.time()) + b"x" * max(0, size - _HEADER.size)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class ProbeError(Exception):
+    pass
+
+
+def probe_executor():
+    """Probes block for up to throughput_probe.max_duration_seconds, so they get their own small pool instead of using threads of kopf"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=int(config_get("throughput_probe.max_concurrent", default=2)), thread_name_prefix="throughput-probe")
+        return _executor
+
+
+def _sent_at(run_id, body):
+    if len(body) < _HEADER.size:
+        return None
+    message_run_id, sent_at = _HEADER.unpack(body[:_HEADER.size])
+    return sent_at if message_run_id == run_id else None
+
+
+class ProbeResult:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.foreign = 0
+        self.latencies = []
+
+    def add_sent(self):
+        with self._lock:
+            self.sent += 1
+
+    def add_received(self, latency):
+        with self._lock:
+            self.received += 1
+            self.latencies.append(latency)
+
+    def add_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def add_foreign(self):
+        with self._lock:
+            self.foreign += 1
+
+    def summary(self, duration, consumed):
+        # Publish-only probes (topics) report the publish rate and the latency until the broker accepted the message
+        count = self.received if consumed else self.sent
+        latencies = sorted(self.latencies)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else None
+        return {
+            "sent": self.sent,
+            "received": self.received,
+            "errors": self.errors,
+            "foreignMessages": self.foreign,
+            "durationSeconds": round(duration, 3),
+            "messagesPerSecond": round(count / duration, 1) if duration > 0 else 0,
+            "p99LatencyMs": round(p99 * 1000, 2) if p99 is not None else None,
+        }
+
+
+class RabbitMQProbeClient:
+    def __init__(self, credentials, hostname, temporary=False):
+        # Imported here so the operator does not need the amqp libraries unless probes are used
+        import pika
+        self._pika = pika
+        self._parameters = pika.ConnectionParameters(host=hostname, port=int(credentials["port"]), credentials=pika.PlainCredentials(credentials["user"], credentials["password"]))
+        _, entity_type, self._entity_name = credentials["entity"].split("/", 2)
+        self.consumes = entity_type == "queue"
+        self._temporary = temporary
+
+    def has_messages(self):
+        """Declares the queue if the probe uses a temporary queue, otherwise checks if the queue already contains messages"""
+        connection = self._pika.BlockingConnection(self._parameters)
+        try:
+            channel = connection.channel()
+            if self._temporary:
+                # Deleted by the broker once the consumer of the probe is gone
+                channel.queue_declare(self._entity_name, auto_delete=True)
+                return False
+            return channel.queue_declare(self._entity_name, passive=True).method.message_count > 0
+        finally:
+            connection.close()
+
+    def publish(self, run_id, messages, size, deadline, result):
+        connection = self._pika.BlockingConnection(self._parameters)
+        try:
+            channel = connection.channel()
+            channel.confirm_delivery()
+            exchange, routing_key = ("", self._entity_name) if self.consumes else (self._entity_name, "")
+            for _ in range(messages):
+                if time.monotonic() >= deadline:
+                    break
+                start = time.time()
+                try:
+                    channel.basic_publish(exchange, routing_key, _message(run_id, size))
+                    result.add_sent()
+                    if not self.consumes:
+                        result.add_received(time.time() - start)
+                except (self._pika.exceptions.UnroutableError, self._pika.exceptions.NackError):
+                    result.add_error()
+        finally:
+            connection.close()
+
+    def consume(self, run_id, messages, deadline, result):
+        connection = self._pika.BlockingConnection(self._parameters)
+        try:
+            channel = connection.channel()
+            received = 0
+            for method, _, body in channel.consume(self._entity_name, inactivity_timeout=1):
+                if method is not None:
+                    sent_at = _sent_at(run_id, body)
+                    if sent_at is None:
+                        # A message of another producer is returned to the queue and the probe stops consuming, so it is delivered at most once more
+                        channel.basic_nack(method.delivery_tag, requeue=True)
+                        result.add_foreign()
+                        break
+                    channel.basic_ack(method.delivery_tag)
+                    received += 1
+                    result.add_received(time.time() - sent_at)
+                if received >= messages or time.monotonic() >= deadline:
+                    break
+            channel.cancel()
+        finally:
+            connection.close()
+
+
+class ServiceBusProbeClient:
+    def __init__(self, credentials, hostname, is_queue):
+        # Imported here so the operator does not need the amqp libraries unless probes are used
+        from azure.core.credentials import AzureNamedKeyCredential, AzureSasCredential
+        from azure.servicebus import ServiceBusClient, ServiceBusMessage
+        self._message_class = ServiceBusMessage
+        if credentials["auth_method"] == "cbs":
+            credential = AzureSasCredential(credentials["token"])
+        else:
+            credential = AzureNamedKeyCredential(credentials["user"], credentials["password"])
+        self._client = ServiceBusClient(hostname, credential)
+        self._entity_name = credentials["entity"]
+        self.consumes = is_queue
+
+    def has_messages(self):
+        # Peeking does not lock the messages or increase their delivery count
+        with self._client.get_queue_receiver(self._entity_name) as receiver:
+            return bool(receiver.peek_messages(max_message_count=1))
+
+    def publish(self, run_id, messages, size, deadline, result):
+        if self.consumes:
+            sender = self._client.get_queue_sender(self._entity_name)
+        else:
+            sender = self._client.get_topic_sender(self._entity_name)
+        with sender:
+            for _ in range(messages):
+                if time.monotonic() >= deadline:
+                    break
+                start = time.time()
+                try:
+                    sender.send_messages(self._message_class(_message(run_id, size)))
+                    result.add_sent()
+                    if not self.consumes:
+                        result.add_received(time.time() - start)
+                except Exception:
+                    result.add_error()
+
+    def consume(self, run_id, messages, deadline, result):
+        received = 0
+        with self._client.get_queue_receiver(self._entity_name) as receiver:
+            while received < messages and time.monotonic() < deadline:
+                foreign = False
+                for message in receiver.receive_messages(max_message_count=100, max_wait_time=1):
+                    sent_at = _sent_at(run_id, b"".join(message.body))
+                    if sent_at is None or foreign:
+                        # Messages of other producers are unlocked again and the probe stops consuming, so their delivery count increases at most by one
+                        receiver.abandon_message(message)
+                        if sent_at is None:
+                            result.add_foreign()
+                            foreign = True
+                        continue
+                    receiver.complete_message(message)
+                    received += 1
+                    result.add_received(time.time() - sent_at)
+                if foreign:
+                    break
+
+
+def run_probe(credentials, is_queue, messages, size, timeout, hostname=None, temporary=False):
+    """Publishes the given number of messages to the entity of the credentials and, for queues, consumes them concurrently.
+       Stops after the timeout and returns the throughput, the p99 latency and the number of errors.
+       Queues must be empty when the probe starts, with temporary (rabbitmq only) the queue is declared by the probe"""
+    hostname = hostname or credentials["hostname"]
+    if credentials["protocol"] == "amqp":
+        client = RabbitMQProbeClient(credentials, hostname, temporary)
+    else:
+        client = ServiceBusProbeClient(credentials, hostname, is_queue)
+    if client.consumes and client.has_messages():
+        raise ProbeError("The queue contains messages, probes only run on queues without other traffic")
+    run_id = os.urandom(16)
+    result = ProbeResult()
+    start = time.monotonic()
+    deadline = start + timeout
+    consumer = None
+    if client.consumes:
+        def _consume():
+            try:
+                client.consume(run_id, messages, deadline, result)
+            except Exception:
+                result.add_error()
+        consumer = threading.Thread(target=_consume, name="throughput-probe-consumer")
+        consumer.start()
+    try:
+        client.publish(run_id, messages, size, deadline, result)
+    finally:
+        if consumer:
+            consumer.join()
+    return result.summary(time.monotonic() - start, client.consumes)
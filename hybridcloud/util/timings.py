@@ -0,0 +1,67 @@
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from . import metrics
+
+
+WAIT = "waitForParent"
+VALIDATION = "validation"
+ENTITY = "entity"
+CREDENTIALS = "credentials"
+SECRET = "secret"
+
+
+def _utc(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        # kopf reports its timestamps as naive utc
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _seconds_since(value):
+    return round((datetime.now(tz=timezone.utc) - value).total_seconds(), 3)
+
+
+class PhaseTimings:
+    """Measures how long the phases of a reconcile take so the breakdown can be written to the status of the object"""
+
+    def __init__(self, kind, meta, started=None):
+        self._kind = kind
+        self._created = _utc(meta.get("creationTimestamp"))
+        # kopf passes the time of the first attempt of the handler so time spent in retries is included
+        self._started = _utc(started) or datetime.now(tz=timezone.utc)
+        self._phases = dict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._phases[name] = round(self._phases.get(name, 0) + time.monotonic() - start, 3)
+
+    def waited(self):
+        """Records the time since the first attempt of the handler as time spent waiting for the parent object"""
+        with self._lock:
+            self._phases[WAIT] = _seconds_since(self._started)
+
+    def status(self, previous=None):
+        """Returns the timings for the status of the finished object. The time from creation to the first finished reconcile is kept"""
+        with self._lock:
+            timings = {
+                "phases": dict(self._phases),
+                "reconcileSeconds": _seconds_since(self._started),
+            }
+        time_to_ready = (previous or dict()).get("timeToReadySeconds")
+        if time_to_ready is None and self._created:
+            time_to_ready = _seconds_since(self._created)
+            metrics.observe_time_to_ready(self._kind, time_to_ready)
+        timings["timeToReadySeconds"] = time_to_ready
+        return timings
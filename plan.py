@@ -0,0 +1,5 @@
+from hybridcloud import plan
+
+
+if __name__ == "__main__":
+    plan.run()
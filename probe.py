@@ -0,0 +1,5 @@
+from hybridcloud import probe
+
+
+if __name__ == "__main__":
+    probe.run()
@@ -0,0 +1,49 @@
+from unittest import mock
+from hybridcloud.util import journal as journal_module
+from hybridcloud.util.journal import Journal
+
+
+RESOURCE = object()
+SPEC = {"brokerRef": {"name": "broker"}, "credentialsSecret": "topic-credentials"}
+
+
+class FakeStatus:
+    """Merges status patches like the kubernetes api. Without a status subresource every write bumps the generation"""
+
+    def __init__(self):
+        self.status = dict()
+        self.generation = 1
+
+    def patch(self, resource, namespace, name, status):
+        self.status.update(status)
+        self.generation += 1
+
+
+def _journal(fake, spec):
+    return Journal(RESOURCE, "default", "topic", spec, dict(fake.status))
+
+
+def test_recorded_step_is_skipped_after_restart():
+    fake = FakeStatus()
+    with mock.patch.object(journal_module, "patch_namespaced_custom_object_status", fake.patch), \
+            mock.patch.object(journal_module, "config_get", return_value=True):
+        journal = _journal(fake, SPEC)
+        assert journal.run("entity", lambda: "topic-name") == "topic-name"
+        # Another status write of the handler before the restart
+        fake.patch(RESOURCE, "default", "topic", {"deployment": {"status": "working"}})
+
+        resumed = _journal(fake, dict(SPEC))
+        step = mock.Mock()
+        assert resumed.done("entity")
+        assert resumed.run("entity", step) == "topic-name"
+        step.assert_not_called()
+
+
+def test_changed_spec_invalidates_journal():
+    fake = FakeStatus()
+    with mock.patch.object(journal_module, "patch_namespaced_custom_object_status", fake.patch), \
+            mock.patch.object(journal_module, "config_get", return_value=True):
+        _journal(fake, SPEC).record("entity", "topic-name")
+
+        resumed = _journal(fake, dict(SPEC, credentialsSecret="other-credentials"))
+        assert not resumed.done("entity")
@@ -0,0 +1,50 @@
+from unittest import mock
+import pytest
+from hybridcloud.backends import rabbitmq
+from hybridcloud.util import instrumentation
+
+
+SPEC = {"queue": {"defaultTTLSeconds": 60, "enableDeadLettering": True, "maxDeliveryCount": 5}}
+
+
+def _config_get(key, default=None, fail_if_missing=False):
+    return default
+
+
+def _response(body=None):
+    response = mock.Mock(ok=body is not None, status_code=200 if body is not None else 404)
+    response.json.return_value = body
+    return response
+
+
+@pytest.fixture
+def backend():
+    with mock.patch.object(rabbitmq, "config_get", _config_get), mock.patch.object(instrumentation, "config_get", _config_get), \
+            mock.patch.object(rabbitmq.recording, "session"):
+        backend = rabbitmq.RabbitMQBackend(mock.Mock())
+        backend._api_put = mock.Mock()
+        yield backend
+
+
+def test_existing_queue_without_arguments_is_kept(backend):
+    backend._api_get = mock.Mock(return_value=_response({"durable": False, "arguments": {}}))
+
+    assert backend.queue_spec_valid("default", "orders", SPEC, "broker") == (True, "")
+    assert backend.create_or_update_queue("default", "orders", SPEC, "broker") == "default-orders"
+    backend._api_put.assert_not_called()
+    backend._logger.warning.assert_called_once()
+
+
+def test_new_queue_is_declared_with_arguments(backend):
+    backend._api_get = mock.Mock(return_value=_response())
+
+    backend.create_or_update_queue("default", "orders", SPEC, "broker")
+    (_, dead_letter_url), _ = backend._api_put.call_args_list[0]
+    (_, queue_url), queue_kwargs = backend._api_put.call_args_list[1]
+    assert dead_letter_url == "queues/%2F/default-orders-deadletter"
+    assert queue_url == "queues/%2F/default-orders"
+    assert queue_kwargs["json"]["arguments"] == {
+        "x-message-ttl": 60000,
+        "x-dead-letter-exchange": "",
+        "x-dead-letter-routing-key": "default-orders-deadletter",
+    }